@@ -0,0 +1,357 @@
+"""
+Load test for the relay against local stand-ins for Entra ID, Graph and Azure Tables.
+
+Starts the mock services, runs the relay (src/main.py via relay.py) as a child
+process pointed at them, and drives it with concurrent SMTP clients sending a
+mix of message sizes, quoted-printable parts and Bcc recipients. Reports
+throughput, latency percentiles and the relay's memory use.
+
+    python benchmarks/bench.py --clients 50 --messages 40
+    python benchmarks/bench.py --json baseline.json
+    python benchmarks/bench.py --compare baseline.json   # exits 1 on regression
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import quopri
+import random
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+from mock_services import MockServices
+
+
+SMTP_PORT = 8025
+
+_SIZE_UNITS = {'k': 1024, 'm': 1024 * 1024}
+
+
+def parse_sizes(value: str) -> list[tuple[int, float]]:
+    """
+    Parse a size mix like "2k:60,50k:30,1m:10" into (bytes, weight) pairs.
+    """
+    sizes = []
+    for item in value.split(','):
+        size, _, weight = item.partition(':')
+        size = size.strip().lower()
+        multiplier = _SIZE_UNITS.get(size[-1], 1)
+        sizes.append((int(float(size.rstrip('km')) * multiplier), float(weight or 1)))
+    return sizes
+
+
+def build_message(size: int, quoted_printable: bool, to: str) -> bytes:
+    """
+    Build a multipart message of roughly size bytes with a text part (quoted-printable
+    if requested) and a base64 attachment making up the rest.
+    """
+    text = ("Benchmark message with some non-ASCII: café über naïve. " * 8).encode('utf-8')
+    if quoted_printable:
+        text_part = b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n" + quopri.encodestring(text).replace(b"\n", b"\r\n")
+    else:
+        text_part = b"Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n" + base64.encodebytes(text).replace(b"\n", b"\r\n")
+
+    attachment = base64.encodebytes(os.urandom(max(0, size - 1024) * 3 // 4)).replace(b"\n", b"\r\n")
+    message = (
+        f"From: sender@bench.example\r\nTo: {to}\r\nSubject: Benchmark\r\n"
+        f"Message-ID: <{uuid.uuid4()}@bench.example>\r\nMIME-Version: 1.0\r\n"
+        "Content-Type: multipart/mixed; boundary=\"BENCH\"\r\n\r\n"
+    ).encode('ascii')
+    message += b"--BENCH\r\n" + text_part + b"\r\n"
+    if attachment:
+        message += b"--BENCH\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n"
+        message += b"Content-Disposition: attachment; filename=\"data.bin\"\r\n\r\n" + attachment
+    message += b"--BENCH--\r\n"
+    # dot-stuffing for the DATA phase
+    return re.sub(rb'(?m)^\.', b'..', message)
+
+
+class SMTPClient:
+    """
+    Minimal asyncio SMTP client; enough for EHLO, AUTH PLAIN and sending messages.
+    """
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        await self._expect(220)
+
+    async def _reply(self) -> int:
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Connection closed by server")
+            if line[3:4] != b'-':
+                return int(line[:3])
+
+    async def _expect(self, *codes: int):
+        code = await self._reply()
+        if code not in codes:
+            raise RuntimeError(f"Unexpected SMTP reply {code}")
+
+    async def command(self, line: str, *codes: int):
+        self.writer.write(line.encode('ascii') + b"\r\n")
+        await self._expect(*codes)
+
+    async def login(self, username: str, password: str):
+        await self.command("EHLO bench.example", 250)
+        token = base64.b64encode(f"\0{username}\0{password}".encode('utf-8')).decode('ascii')
+        await self.command(f"AUTH PLAIN {token}", 235)
+
+    async def send(self, mail_from: str, rcpt_tos: list[str], data: bytes):
+        await self.command(f"MAIL FROM:<{mail_from}>", 250)
+        for rcpt in rcpt_tos:
+            await self.command(f"RCPT TO:<{rcpt}>", 250)
+        await self.command("DATA", 354)
+        self.writer.write(data + b".\r\n")
+        await self._expect(250)
+
+    async def quit(self):
+        try:
+            await self.command("QUIT", 221)
+        finally:
+            self.writer.close()
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def tree_rss(pid: int) -> int:
+    """
+    Resident memory of a process and all its descendants in bytes (Linux only).
+    """
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        pending.extend(children.get(current, []))
+    return total
+
+
+class Benchmark:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latencies: list[float] = []
+        self.auth_latencies: list[float] = []
+        self.errors = 0
+        self.peak_rss = 0
+        self.credentials = [(str(uuid.uuid4()), str(uuid.uuid4()), f"secret-{i}") for i in range(args.credentials)]
+
+    def _templates(self) -> list[tuple[bytes, list[str]]]:
+        # a fixed pool of messages, so generating them does not compete with the relay for CPU
+        sizes = parse_sizes(self.args.sizes)
+        templates = []
+        for _ in range(self.args.templates):
+            size = self.rng.choices([s for s, _ in sizes], [w for _, w in sizes])[0]
+            rcpt_tos = ["to@bench.example"]
+            if self.rng.random() < self.args.bcc_ratio:
+                rcpt_tos.append("hidden@bench.example")
+            templates.append((build_message(size, self.rng.random() < self.args.qp_ratio, rcpt_tos[0]), rcpt_tos))
+        return templates
+
+    def _relay_env(self, services_url: str) -> dict:
+        entities = [
+            {'PartitionKey': 'user', 'RowKey': f"app{i}", 'tenant_id': tenant, 'client_id': client, 'from_email': f"app{i}@bench.example"}
+            for i, (tenant, client, _) in enumerate(self.credentials)
+        ]
+        env = {
+            **os.environ,
+            'TLS_SOURCE': 'off',
+            'REQUIRE_TLS': 'false',
+            'LOG_LEVEL': 'ERROR',
+            'AZURE_AUTHORITY_HOST': services_url,
+            'GRAPH_ENDPOINT': services_url,
+            'GRAPH_LARGE_MESSAGE_THRESHOLD': '0',
+            'AZURE_TABLES_URL': 'https://bench.table.core.windows.net/users',
+            'WORKERS': str(self.args.workers),
+            'BENCH_TABLE_ENTITIES': json.dumps(entities),
+            'BENCH_TABLE_LATENCY': str(self.args.table_latency),
+            'PYTHONWARNINGS': 'ignore'
+        }
+        for item in self.args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+        return env
+
+    async def _wait_for_relay(self, process: subprocess.Popen):
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Relay exited with code {process.returncode}")
+            # the relay listens while starting up but answers 421 until it is ready
+            try:
+                with socket.create_connection(('127.0.0.1', SMTP_PORT), timeout=1) as sock:
+                    if sock.recv(3) == b'220':
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("Relay was not ready within 30s")
+
+    async def _watch_memory(self, pid: int):
+        while True:
+            self.peak_rss = max(self.peak_rss, tree_rss(pid))
+            await asyncio.sleep(0.5)
+
+    async def _client(self, index: int, templates: list[tuple[bytes, list[str]]]):
+        tenant, client, secret = self.credentials[index % len(self.credentials)]
+        username = f"app{index % len(self.credentials)}@lookup" if self.rng.random() < self.args.lookup_ratio else f"{tenant}@{client}"
+
+        smtp = SMTPClient()
+        try:
+            await smtp.connect('127.0.0.1', SMTP_PORT)
+            start = time.perf_counter()
+            await smtp.login(username, secret)
+            self.auth_latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            print(f"client {index}: login failed: {e}", file=sys.stderr)
+            self.errors += self.args.messages
+            return
+
+        for _ in range(self.args.messages):
+            data, rcpt_tos = self.rng.choice(templates)
+            start = time.perf_counter()
+            try:
+                await smtp.send("sender@bench.example", rcpt_tos, data)
+                self.latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                self.errors += 1
+                if isinstance(e, ConnectionError):
+                    break
+        try:
+            await smtp.quit()
+        except Exception:
+            pass
+
+    async def run(self) -> dict:
+        services = MockServices(self.args.token_latency, self.args.graph_latency, self.args.throttle_ratio)
+        services_url = await services.start()
+        templates = self._templates()
+
+        relay = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relay.py')],
+            env=self._relay_env(services_url)
+        )
+        watcher = None
+        try:
+            await self._wait_for_relay(relay)
+            baseline_rss = tree_rss(relay.pid)
+            watcher = asyncio.create_task(self._watch_memory(relay.pid))
+
+            start = time.perf_counter()
+            await asyncio.gather(*(self._client(i, templates) for i in range(self.args.clients)))
+            elapsed = time.perf_counter() - start
+        finally:
+            if watcher:
+                watcher.cancel()
+            relay.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.to_thread(relay.wait, 60)
+            except subprocess.TimeoutExpired:
+                relay.kill()
+            await services.close()
+
+        sent = len(self.latencies)
+        return {
+            'messages': sent,
+            'errors': self.errors,
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(sent / elapsed, 2) if elapsed else 0.0,
+            'latency_p50_ms': round(percentile(self.latencies, 50) * 1000, 2),
+            'latency_p99_ms': round(percentile(self.latencies, 99) * 1000, 2),
+            'latency_mean_ms': round(statistics.fmean(self.latencies) * 1000, 2) if self.latencies else 0.0,
+            'auth_p50_ms': round(percentile(self.auth_latencies, 50) * 1000, 2),
+            'auth_p99_ms': round(percentile(self.auth_latencies, 99) * 1000, 2),
+            'rss_start_mb': round(baseline_rss / 1024 / 1024, 1),
+            'rss_peak_mb': round(self.peak_rss / 1024 / 1024, 1),
+            'token_requests': services.token_requests,
+            'graph_requests': services.graph_requests,
+            'graph_throttled': services.graph_throttled,
+            'graph_batches': services.graph_batches,
+            'graph_megabytes': round(services.graph_bytes / 1024 / 1024, 1)
+        }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Return a description of every metric that regressed by more than tolerance.
+    """
+    regressions = []
+    if result['messages_per_second'] < baseline['messages_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput {result['messages_per_second']}/s < baseline {baseline['messages_per_second']}/s")
+    for key in ('latency_p50_ms', 'latency_p99_ms', 'auth_p99_ms', 'rss_peak_mb'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    if result['errors'] > baseline['errors']:
+        regressions.append(f"errors {result['errors']} > baseline {baseline['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=20, help='concurrent SMTP connections')
+    parser.add_argument('--messages', type=int, default=25, help='messages sent per connection')
+    parser.add_argument('--sizes', default='4k:60,64k:30,512k:8,2m:2', help='message size mix as size:weight,...')
+    parser.add_argument('--qp-ratio', type=float, default=0.3, help='share of messages with a quoted-printable part')
+    parser.add_argument('--bcc-ratio', type=float, default=0.3, help='share of messages with a recipient missing from the headers')
+    parser.add_argument('--lookup-ratio', type=float, default=0.5, help='share of connections logging in with a table lookup ID')
+    parser.add_argument('--credentials', type=int, default=10, help='number of distinct client credentials')
+    parser.add_argument('--templates', type=int, default=50, help='number of distinct messages to generate')
+    parser.add_argument('--token-latency', type=float, default=0.1, help='seconds per token request')
+    parser.add_argument('--graph-latency', type=float, default=0.05, help='seconds per sendMail request')
+    parser.add_argument('--table-latency', type=float, default=0.02, help='seconds per table query')
+    parser.add_argument('--throttle-ratio', type=float, default=0.0, help='share of sendMail requests answered with 429')
+    parser.add_argument('--workers', type=int, default=1, help='WORKERS setting of the relay')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra relay setting (repeatable)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the message mix')
+    parser.add_argument('--json', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results from FILE and exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed relative regression for --compare')
+    args = parser.parse_args()
+
+    result = asyncio.run(Benchmark(args).run())
+    for key, value in result.items():
+        print(f"{key:>22}: {value}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import asyncio
+import random
+import re
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+
+class MockServices:
+    """
+    Local stand-ins for the Entra ID token endpoint and Graph sendMail and $batch, served
+    from one aiohttp application. Latencies and the share of throttled (429)
+    responses are configurable; requests are counted for the report.
+    """
+
+    def __init__(self, token_latency: float, graph_latency: float, throttle_ratio: float):
+        self.token_latency = token_latency
+        self.graph_latency = graph_latency
+        self.throttle_ratio = throttle_ratio
+        self.token_requests = 0
+        self.graph_requests = 0
+        self.graph_throttled = 0
+        self.graph_batches = 0
+        self.graph_bytes = 0
+        self._runner: web.AppRunner | None = None
+        self.port = 0
+
+    async def _token(self, request: web.Request) -> web.Response:
+        self.token_requests += 1
+        form = await request.post()
+        await asyncio.sleep(self.token_latency)
+        return web.json_response({
+            "token_type": "Bearer",
+            "expires_in": 3599,
+            "access_token": f"mock-{request.match_info['tenant']}-{form.get('client_id')}"
+        })
+
+    async def _send_mail(self, request: web.Request) -> web.Response:
+        self.graph_requests += 1
+        body = await request.read()
+        self.graph_bytes += len(body)
+        await asyncio.sleep(self.graph_latency)
+        if self.throttle_ratio and random.random() < self.throttle_ratio:
+            self.graph_throttled += 1
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        return web.Response(status=202)
+
+    async def _batch(self, request: web.Request) -> web.Response:
+        self.graph_batches += 1
+        body = await request.json()
+        await asyncio.sleep(self.graph_latency)
+        responses = []
+        for item in body['requests']:
+            self.graph_requests += 1
+            self.graph_bytes += len(item.get('body', ''))
+            if self.throttle_ratio and random.random() < self.throttle_ratio:
+                self.graph_throttled += 1
+                responses.append({'id': item['id'], 'status': 429, 'headers': {'Retry-After': '1'}})
+            else:
+                responses.append({'id': item['id'], 'status': 202})
+        return web.json_response({'responses': responses})
+
+    async def start(self) -> str:
+        """
+        Start serving on a free local port and return the base URL.
+        """
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post('/{tenant}/oauth2/v2.0/token', self._token)
+        app.router.add_post('/v1.0/users/{user}/sendMail', self._send_mail)
+        app.router.add_post('/v1.0/$batch', self._batch)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# Conditions the relay puts in its table queries: field eq 'value' / field eq @param / Timestamp ge @param
+_CONDITION_PATTERN = re.compile(r"(\w+) (eq|ge) (?:'([^']*)'|@(\w+))")
+
+
+class _Entity(dict):
+    def __init__(self, values: dict):
+        super().__init__(values)
+        self.metadata = {'timestamp': values.get('Timestamp')}
+
+
+class MockTableClient:
+    """
+    In-process stand-in for azure.data.tables.aio.TableClient that understands
+    the filters the relay sends. Every query waits latency seconds, like a round
+    trip to the storage account would.
+    """
+
+    def __init__(self, entities: list[dict], latency: float):
+        now = datetime.now(timezone.utc)
+        self.entities = [{**entity, 'Timestamp': now} for entity in entities]
+        self.latency = latency
+        self.queries = 0
+
+    def _matches(self, entity: dict, query_filter: str, parameters: dict) -> bool:
+        for field, op, literal, parameter in _CONDITION_PATTERN.findall(query_filter):
+            value = parameters.get(parameter) if parameter else literal
+            if op == 'eq' and entity.get(field) != value:
+                return False
+            if op == 'ge' and entity.get(field) < value:
+                return False
+        return True
+
+    async def query_entities(self, query_filter: str, parameters: dict | None = None, **kwargs):
+        self.queries += 1
+        await asyncio.sleep(self.latency)
+        for entity in self.entities:
+            if self._matches(entity, query_filter, parameters or {}):
+                yield _Entity(entity)
+
+    async def close(self):
+        pass
@@ -0,0 +1,29 @@
+"""
+Runs the relay from src/ unchanged, except that Azure Table queries go to an
+in-process MockTableClient. Started by bench.py; the table content and query
+latency come from BENCH_TABLE_ENTITIES (JSON list) and BENCH_TABLE_LATENCY.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import azure_table
+import main
+from mock_services import MockTableClient
+
+# at module level, so worker processes spawned by the supervisor get the stand-in too
+_table = MockTableClient(
+    json.loads(os.environ.get('BENCH_TABLE_ENTITIES', '[]')),
+    float(os.environ.get('BENCH_TABLE_LATENCY', '0'))
+)
+azure_table.get_client = lambda: _table
+
+
+if __name__ == '__main__':
+    main.setup_logging()
+    if main.WORKERS > 1:
+        main.supervisor.supervise(main.run_worker, main.WORKERS)
+    else:
+        main.run()
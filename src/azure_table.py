@@ -1,10 +1,192 @@
-from azure.identity import DefaultAzureCredential
-from azure.data.tables import TableClient
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
+
+import metrics
+from cache import TTLCache
+# The Azure SDKs take a while to import; they are only loaded once a client is needed
+if TYPE_CHECKING:
+    from azure.identity.aio import DefaultAzureCredential
+    from azure.data.tables.aio import TableClient
+
+from env import (
+    AZURE_TABLES_PARTITION_KEY,
+    AZURE_TABLES_URL,
+    AZURE_TABLES_CACHE_SIZE,
+    AZURE_TABLES_CACHE_TTL,
+    AZURE_TABLES_NEGATIVE_CACHE_TTL,
+    AZURE_TABLES_SNAPSHOT,
+    AZURE_TABLES_SNAPSHOT_INTERVAL,
+    AZURE_TABLES_SNAPSHOT_FULL_INTERVAL
+)
+
+
+# Resolved entities (or None for "not found") keyed by the lookup that produced them
+entity_cache = TTLCache('table', AZURE_TABLES_CACHE_SIZE)
+
+# Delta queries start this far before the newest Timestamp seen, to catch writes that
+# committed out of order
+_SNAPSHOT_DELTA_OVERLAP = timedelta(seconds=60)
+
+# In snapshot mode the whole partition is held in memory, indexed by RowKey and by
+# (tenant_id, client_id). _snapshot_watermark is the newest entity Timestamp seen.
+_snapshot_rows: dict[str, dict] | None = None
+_snapshot_senders: dict[tuple[str, str], dict] = {}
+_snapshot_watermark: datetime | None = None
+
+# Shared for the lifetime of the process; see get_client() and close()
+_credential: 'DefaultAzureCredential | None' = None
+_client: 'TableClient | None' = None
+
+
+def get_client() -> 'TableClient':
+    """
+    Return the shared async TableClient, creating it and its credential on first use.
+    Reusing them avoids walking the credential chain and reconnecting on every lookup.
+    """
+    global _credential, _client
+    if _client is None:
+        if not AZURE_TABLES_URL:
+            raise ValueError("AZURE_TABLES_URL environment variable not set")
+        from azure.identity.aio import DefaultAzureCredential
+        from azure.data.tables.aio import TableClient
+
+        _credential = DefaultAzureCredential()
+        _client = TableClient.from_table_url(table_url=AZURE_TABLES_URL, credential=_credential) # pyright: ignore[reportArgumentType]
+    return _client
+
+
+async def close():
+    """
+    Close the shared TableClient and credential, if they were created.
+    """
+    global _credential, _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+    if _credential is not None:
+        await _credential.close()
+        _credential = None
+
+
+async def _query_first(query_filter: str) -> dict | None:
+    """
+    Return the first entity matching query_filter, or None if there is none.
+    """
+    with metrics.round_trip('tables', metrics.TABLE_QUERY_DURATION):
+        entities = get_client().query_entities(query_filter=query_filter, results_per_page=1)
+        async for entity in entities:
+            return dict(entity)
+    return None
+
+
+async def _cached_query(key: tuple, query_filter: str) -> dict | None:
+    """
+    Run query_filter through the entity cache. Found entities are cached for
+    AZURE_TABLES_CACHE_TTL seconds, misses for AZURE_TABLES_NEGATIVE_CACHE_TTL
+    seconds. Query errors are not cached.
+    """
+    async def fetch() -> tuple[dict | None, float]:
+        try:
+            entity = await _query_first(query_filter)
+        except Exception as e:
+            raise RuntimeError(f"Failed to query Azure Table: {str(e)}") from e
+
+        if entity is None:
+            return None, AZURE_TABLES_NEGATIVE_CACHE_TTL
+        return entity, AZURE_TABLES_CACHE_TTL
+
+    return await entity_cache.get_or_fetch(key, fetch)
+
+
+def _index_senders(rows: dict[str, dict]) -> dict[tuple[str, str], dict]:
+    # tables return entities in RowKey order; keep the first match like a query would
+    senders = {}
+    for row_key in sorted(rows):
+        entity = rows[row_key]
+        senders.setdefault((entity.get('tenant_id'), entity.get('client_id')), entity)
+    return senders
 
-from env import AZURE_TABLES_PARTITION_KEY, AZURE_TABLES_URL
 
+async def _query_partition(since: datetime | None = None) -> tuple[dict[str, dict], datetime | None]:
+    """
+    Return all entities of the partition keyed by RowKey, optionally only those
+    modified at or after since, along with the newest Timestamp among them.
+    """
+    query_filter = "PartitionKey eq @partition_key"
+    parameters = {'partition_key': AZURE_TABLES_PARTITION_KEY}
+    if since is not None:
+        query_filter += " and Timestamp ge @since"
+        parameters['since'] = since
+
+    rows = {}
+    newest = None
+    async for entity in get_client().query_entities(query_filter=query_filter, parameters=parameters):
+        rows[entity['RowKey']] = dict(entity)
+        timestamp = entity.metadata.get('timestamp')
+        if timestamp and (newest is None or timestamp > newest):
+            newest = timestamp
+    return rows, newest
+
+
+async def load_snapshot():
+    """
+    Load the whole AZURE_TABLES_PARTITION_KEY partition into memory and replace
+    the current snapshot. Raises RuntimeError if the table cannot be read.
+    """
+    global _snapshot_rows, _snapshot_senders, _snapshot_watermark
+
+    try:
+        rows, newest = await _query_partition()
+    except Exception as e:
+        raise RuntimeError(f"Failed to load Azure Table snapshot: {str(e)}") from e
+
+    _snapshot_rows, _snapshot_senders = rows, _index_senders(rows)
+    _snapshot_watermark = newest
+    logging.info(f"Loaded Azure Table snapshot with {len(rows)} entities")
+
+
+async def _apply_snapshot_delta():
+    global _snapshot_rows, _snapshot_senders, _snapshot_watermark
+    assert _snapshot_rows is not None
 
-def lookup_user(lookup_id: str) -> tuple[str, str, str|None]:
+    since = _snapshot_watermark - _SNAPSHOT_DELTA_OVERLAP if _snapshot_watermark else None
+    changed, newest = await _query_partition(since)
+    changed = {k: v for k, v in changed.items() if _snapshot_rows.get(k) != v}
+    if not changed:
+        return
+
+    rows = {**_snapshot_rows, **changed}
+    _snapshot_rows, _snapshot_senders = rows, _index_senders(rows)
+    if newest and (_snapshot_watermark is None or newest > _snapshot_watermark):
+        _snapshot_watermark = newest
+    logging.info(f"Applied {len(changed)} changed entities to the Azure Table snapshot")
+
+
+async def sync_snapshot():
+    """
+    Keep the snapshot current. Every AZURE_TABLES_SNAPSHOT_INTERVAL seconds only
+    entities modified since the last sync are fetched; deletions are not visible
+    to such delta queries, so the partition is reloaded in full every
+    AZURE_TABLES_SNAPSHOT_FULL_INTERVAL seconds. On errors the previous snapshot
+    stays in use. Runs until cancelled.
+    """
+    last_full = time.monotonic()
+    while True:
+        await asyncio.sleep(AZURE_TABLES_SNAPSHOT_INTERVAL)
+        try:
+            if time.monotonic() - last_full >= AZURE_TABLES_SNAPSHOT_FULL_INTERVAL:
+                await load_snapshot()
+                last_full = time.monotonic()
+            else:
+                await _apply_snapshot_delta()
+        except Exception as e:
+            logging.warning(f"Failed to sync Azure Table snapshot, keeping the previous one: {str(e)}")
+
+
+async def lookup_user(lookup_id: str) -> tuple[str, str, str|None]:
     """
     Search in Azure Table for user information based on the lookup_id (RowKey).
     Returns (tenant_id, client_id, from_email) or raises ValueError if not found.
@@ -12,16 +194,13 @@ def lookup_user(lookup_id: str) -> tuple[str, str, str|None]:
     if not AZURE_TABLES_URL:
         raise ValueError("AZURE_TABLES_URL environment variable not set")
 
-    try:
-        credential = DefaultAzureCredential()
-        with TableClient.from_table_url(table_url=AZURE_TABLES_URL, credential=credential) as client: # pyright: ignore[reportArgumentType]
-            entities = client.query_entities(query_filter=f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}' and RowKey eq '{lookup_id}'")
-            entity = None
-            for i in entities:
-                entity = i
-                break
-    except Exception as e:
-        raise RuntimeError(f"Failed to query Azure Table: {str(e)}") from e
+    if _snapshot_rows is not None:
+        entity = _snapshot_rows.get(lookup_id)
+    else:
+        entity = await _cached_query(
+            ('row', lookup_id),
+            f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}' and RowKey eq '{lookup_id}'"
+        )
 
     if not entity:
         raise ValueError(f"No entity found for RowKey '{lookup_id}'")
@@ -36,7 +215,7 @@ def lookup_user(lookup_id: str) -> tuple[str, str, str|None]:
     return tenant_id, client_id, from_email
 
 
-def verify_table_access():
+async def verify_table_access():
     """
     Verify that the Azure Table is accessible.
     Raises RuntimeError if the table cannot be reached.
@@ -45,19 +224,12 @@ def verify_table_access():
         raise ValueError("AZURE_TABLES_URL must be set when AZURE_TABLES_FORCE_USAGE is enabled")
 
     try:
-        credential = DefaultAzureCredential()
-        with TableClient.from_table_url(table_url=AZURE_TABLES_URL, credential=credential) as client: # pyright: ignore[reportArgumentType]
-            entities = client.query_entities(
-                query_filter=f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}'",
-                results_per_page=1
-            )
-            for _ in entities:
-                break
+        await _query_first(f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}'")
     except Exception as e:
         raise RuntimeError(f"Failed to access Azure Table: {str(e)}") from e
 
 
-def verify_user_in_table(tenant_id: str, client_id: str) -> str | None:
+async def verify_user_in_table(tenant_id: str, client_id: str) -> str | None:
     """
     Verify that a user with the given tenant_id and client_id exists in Azure Table.
     Returns from_email if set, otherwise None.
@@ -66,18 +238,13 @@ def verify_user_in_table(tenant_id: str, client_id: str) -> str | None:
     if not AZURE_TABLES_URL:
         raise ValueError("AZURE_TABLES_URL environment variable not set")
 
-    try:
-        credential = DefaultAzureCredential()
-        with TableClient.from_table_url(table_url=AZURE_TABLES_URL, credential=credential) as client: # pyright: ignore[reportArgumentType]
-            entities = client.query_entities(
-                query_filter=f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}' and tenant_id eq '{tenant_id}' and client_id eq '{client_id}'"
-            )
-            entity = None
-            for i in entities:
-                entity = i
-                break
-    except Exception as e:
-        raise RuntimeError(f"Failed to query Azure Table: {str(e)}") from e
+    if _snapshot_rows is not None:
+        entity = _snapshot_senders.get((tenant_id, client_id))
+    else:
+        entity = await _cached_query(
+            ('sender', tenant_id, client_id),
+            f"PartitionKey eq '{AZURE_TABLES_PARTITION_KEY}' and tenant_id eq '{tenant_id}' and client_id eq '{client_id}'"
+        )
 
     if not entity:
         raise ValueError(f"Sender not authorized: no entry found for tenant_id '{tenant_id}' and client_id '{client_id}'")
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from typing import AsyncContextManager, Callable
+
+import metrics
+from graph import SendResult, is_large_message, send_batch, send_email
+from env import GRAPH_BATCH_SIZE, GRAPH_BATCH_WINDOW, GRAPH_MAILBOX_CONCURRENCY
+
+
+# Upper bound on the JSON payload of one batch request; messages are base64
+# encoded twice in a batch, so this holds roughly 2 MiB of MIME
+_MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def _encoded_size(body: bytes) -> int:
+    # size of base64(base64(body)), plus some room for the request envelope
+    return 4 * ((4 * ((len(body) + 2) // 3) + 2) // 3) + 256
+
+
+class _Item:
+    __slots__ = ('body', 'from_email', 'slot', 'future')
+
+    def __init__(self, body: bytes, from_email: str, slot: Callable[[list[str]], AsyncContextManager], future: asyncio.Future):
+        self.body = body
+        self.from_email = from_email
+        self.slot = slot
+        self.future = future
+
+
+class _Batch:
+    __slots__ = ('items', 'size', 'timer')
+
+    def __init__(self):
+        self.items: list[_Item] = []
+        self.size = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class GraphBatcher:
+    """
+    Coalesces sends that use the same access token into Graph JSON batch requests.
+
+    The first message waits up to window seconds for others to join; a batch is
+    sent as soon as it holds size messages or would exceed the payload limit.
+    Every message still gets its own result, so throttling and errors are
+    handled per SMTP transaction. A batch of one is sent as a plain sendMail,
+    and messages for the large-message path are never batched. A size below 2
+    disables batching.
+
+    Messages join a batch before they hold a concurrency slot; the batch request
+    enters the slot of its first message, which takes a mailbox slot for each
+    message it carries. A batch holds at most per_mailbox messages of one
+    sender and is sent once that is reached.
+    """
+
+    def __init__(self, size: int = GRAPH_BATCH_SIZE, window: float = GRAPH_BATCH_WINDOW, per_mailbox: int = GRAPH_MAILBOX_CONCURRENCY):
+        self.size = size
+        self.window = window
+        self.per_mailbox = max(1, per_mailbox)
+        self._pending: dict[str, _Batch] = {}
+        # batch requests in flight, referenced so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    def _flush(self, access_token: str):
+        batch = self._pending.pop(access_token, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        if not batch.items:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._send(access_token, batch.items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, access_token: str, items: list[_Item]):
+        try:
+            async with items[0].slot([item.from_email for item in items]):
+                metrics.GRAPH_BATCH_SIZE.observe(len(items))
+                with metrics.round_trip('graph', metrics.GRAPH_REQUEST_DURATION):
+                    if len(items) == 1:
+                        results = [await send_email(access_token, items[0].body, items[0].from_email)]
+                    else:
+                        results = await send_batch(access_token, [(item.body, item.from_email) for item in items])
+        except asyncio.TimeoutError:
+            logging.warning(f"Timed out waiting for a Graph send slot for a batch of {len(items)} message(s)")
+            results = [SendResult(success=False, retryable=True)] * len(items)
+        except Exception as e:
+            logging.exception(f"Unexpected error while sending a batch: {str(e)}")
+            results = [SendResult(success=False)] * len(items)
+
+        for item, result in zip(items, results):
+            if not item.future.done():
+                item.future.set_result(result)
+
+    def accepts(self, body: bytes) -> bool:
+        """
+        Return True if a message is sent through a batch, False if it is sent on its own.
+        """
+        return self.size >= 2 and not is_large_message(len(body)) and _encoded_size(body) <= _MAX_BATCH_BYTES
+
+    async def send(self, access_token: str, body: bytes, from_email: str, slot: Callable[[list[str]], AsyncContextManager]) -> SendResult:
+        """
+        Send a message accepted by accepts(), batched with other messages using the
+        same access token. slot(from_emails) is entered around the batch request;
+        if it raises asyncio.TimeoutError the messages fail as retryable.
+        """
+        size = _encoded_size(body)
+        sender = from_email.lower()
+
+        batch = self._pending.get(access_token)
+        if batch is not None and (
+            batch.size + size > _MAX_BATCH_BYTES
+            or sum(1 for item in batch.items if item.from_email.lower() == sender) >= self.per_mailbox
+        ):
+            self._flush(access_token)
+            batch = None
+        if batch is None:
+            batch = self._pending[access_token] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, access_token)
+
+        item = _Item(body, from_email, slot, asyncio.get_running_loop().create_future())
+        batch.items.append(item)
+        batch.size += size
+        if len(batch.items) >= self.size:
+            self._flush(access_token)
+
+        try:
+            return await item.future
+        except asyncio.CancelledError:
+            # not sent yet: leave the batch, so the message is not delivered behind the client's back
+            if item in batch.items and self._pending.get(access_token) is batch:
+                batch.items.remove(item)
+                batch.size -= size
+            raise
+
+
+batcher = GraphBatcher()
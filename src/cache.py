@@ -0,0 +1,101 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+
+_MISSING = object()
+
+# Every cache created, so their statistics can be exported
+instances: list['TTLCache'] = []
+
+
+class TTLCache:
+    """
+    Bounded in-memory cache with per-entry expiry and LRU eviction.
+    Concurrent misses for the same key are collapsed into a single fetch.
+    A maxsize of 0 disables storage but still coalesces concurrent fetches.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._pending: dict[Hashable, asyncio.Task] = {}
+        instances.append(self)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def ttl(self, key: Hashable) -> float | None:
+        """
+        Return the remaining lifetime of key in seconds, or None if it is not cached.
+        Does not count as a use for LRU purposes.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return max(0.0, entry[1] - time.monotonic())
+
+    def pop(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[tuple[Any, float]]]) -> Any:
+        """
+        Return the cached value for key, or await fetch() to produce it.
+        fetch must return a tuple of (value, ttl_seconds).
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            # the fetch keeps running if every waiter goes away, so make sure
+            # its exception is always retrieved
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._pending[key] = task
+        else:
+            self.coalesced += 1
+
+        # shield so that a cancelled session does not abort the fetch for other waiters
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[tuple[Any, float]]]) -> Any:
+        try:
+            value, ttl = await fetch()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            self._pending.pop(key, None)
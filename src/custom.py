@@ -1,18 +1,120 @@
-from aiosmtpd.controller import Controller
-from aiosmtpd.smtp import SMTP, Session, TLSSetupException
-from typing import Any
+from aiosmtpd.controller import UnthreadedController
+from aiosmtpd.smtp import MISSING, SMTP, AuthResult, Session, TLSSetupException
+from typing import Any, Awaitable, List
+import asyncio
+import inspect
 import logging
+import mmap
+import tempfile
 
+import metrics
+import ratelimit
+from env import DATA_SPILL_THRESHOLD
+
+
+class DataBuffer:
+    """
+    Collects the content of a DATA command. Content beyond spill_threshold bytes
+    moves to an anonymous temporary file, which is memory-mapped once complete,
+    so large messages are paged in from disk instead of held in process memory.
+    A spill_threshold of 0 keeps everything in memory.
+    """
+
+    def __init__(self, spill_threshold: int = DATA_SPILL_THRESHOLD):
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self._memory = bytearray()
+        self._file = None
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self._file is not None:
+            self._file.write(data)
+            return
+
+        self._memory += data
+        if self.spill_threshold and len(self._memory) > self.spill_threshold:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._memory)
+            self._memory = bytearray()
+
+    def content(self) -> bytes | mmap.mmap:
+        """
+        Return the collected content: bytes, or a read-only memory map if it was spilled.
+        The memory map stays valid after close().
+        """
+        if self._file is None:
+            return bytes(self._memory)
+        self._file.flush()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memory = bytearray()
+
+
+# Runs the SMTP server on the caller's event loop, so sessions share it with background tasks
+class CustomController(UnthreadedController):
+    def __init__(self, *args, reuse_port: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reuse_port = reuse_port
 
-class CustomController(Controller):
     def factory(self) -> SMTP:
         return CustomSMTP(self.handler, **self.SMTP_kwargs)
 
+    # begin() drives the loop itself; bind from inside the already running loop instead
+    async def start(self) -> None:
+        self.server_coro = self._create_server()
+        self.server = await self.server_coro
+
+    # reuse_port lets several worker processes listen on the same port
+    def _create_server(self) -> Awaitable[asyncio.AbstractServer]:
+        return self.loop.create_server(
+            self._factory_invoker,
+            host=self.hostname,
+            port=self.port,
+            ssl=self.ssl_context,
+            reuse_port=self.reuse_port
+        )
+
 
 class CustomSMTP(SMTP):
     AuthLoginUsernameChallenge = "Username:" # Some clients expect this format
     AuthLoginPasswordChallenge = "Password:"
 
+    _counted = False
+    _client_ip = ''
+    _rejected: str | None = None
+    _in_transaction = False
+
+    def __init__(self, *args, implicit_tls: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        # With implicit TLS the connection is encrypted from the start; offer AUTH
+        # right away (passing auth_require_tls=False would log a warning per connection)
+        if implicit_tls:
+            self._auth_require_tls = False
+
+    # connection_made runs again after STARTTLS; count each client connection once
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        if not self._counted:
+            self._counted = True
+            metrics.ACTIVE_SESSIONS.inc()
+            peer = transport.get_extra_info('peername')
+            self._client_ip = str(peer[0] if isinstance(peer, tuple) else peer)
+            self._rejected = ratelimit.sessions.acquire(self._client_ip)
+        super().connection_made(transport)
+
+    def connection_lost(self, error: Exception | None) -> None:
+        self._end_transaction()
+        if self._counted:
+            self._counted = False
+            metrics.ACTIVE_SESSIONS.dec()
+            if self._rejected is None:
+                ratelimit.sessions.release(self._client_ip)
+        super().connection_lost(error)
+
     # Custom logic to handle AUTH commands which are in lowercase (bug in aio-libs/aiosmtpd#542)
     async def smtp_AUTH(self, arg: str) -> None:    
         args = arg.split()
@@ -21,6 +123,143 @@ class CustomSMTP(SMTP):
             arg = ' '.join(args)
         return await super().smtp_AUTH(arg)
 
+    # The builtin LOGIN/PLAIN mechanisms call the authenticator synchronously; await it
+    # here so the Authenticator can do its token I/O without blocking the event loop
+    async def auth_PLAIN(self, _, args: List[str]) -> AuthResult:
+        result = await super().auth_PLAIN(_, args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def auth_LOGIN(self, _, args: List[str]) -> AuthResult:
+        result = await super().auth_LOGIN(_, args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    def _unavailable(self) -> str | None:
+        """
+        Return the reply for clients while the relay does not accept mail, or None.
+        """
+        if getattr(self.event_handler, 'draining', False):
+            return '421 4.3.2 Service shutting down, try again later'
+        if not getattr(self.event_handler, 'ready', True):
+            return '421 4.3.2 Service starting up, try again later'
+        return None
+
+    # While starting up or shutting down, turn away new connections and new transactions so clients retry elsewhere
+    async def _handle_client(self) -> None:
+        if self._rejected:
+            logging.warning(f"Rejecting connection from {self._client_ip}: {self._rejected} reached")
+            metrics.REJECTED.labels(self._rejected).inc()
+            await self.push('421 4.7.0 Too many connections, try again later')
+            self.transport.close()
+            return
+        reply = self._unavailable()
+        if reply:
+            await self.push(reply)
+            self.transport.close()
+            return
+        await super()._handle_client()
+
+    async def smtp_MAIL(self, arg: str) -> None:
+        reply = self._unavailable()
+        if reply:
+            await self.push(reply)
+            self.transport.close()
+            return
+        await super().smtp_MAIL(arg)
+        if self.envelope is not None and self.envelope.mail_from is not None and not self._in_transaction:
+            self._begin_transaction()
+
+    # Tell the handler about open transactions, so a shutdown drain waits for
+    # messages still being received and not just those already in handle_DATA
+    def _begin_transaction(self):
+        begin = getattr(self.event_handler, 'begin_transaction', None)
+        if begin is not None:
+            self._in_transaction = True
+            begin()
+
+    def _end_transaction(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            self.event_handler.end_transaction()
+
+    # Called after DATA and, through _set_rset_state, on RSET, HELO/EHLO and STARTTLS
+    def _set_post_data_state(self):
+        self._end_transaction()
+        super()._set_post_data_state()
+
+    # Replaces aiosmtpd's DATA handling, which keeps every line as a separate
+    # bytearray and joins them at the end; lines go straight into a DataBuffer
+    # here. Like aiosmtpd, content beyond data_size_limit (MAX_MESSAGE_SIZE) is
+    # discarded as it arrives and answered with 552 once the client is done.
+    async def smtp_DATA(self, arg: str) -> None:
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed("DATA"):
+            return
+        assert self.envelope is not None
+        if not self.envelope.rcpt_tos:
+            await self.push('503 Error: need RCPT command')
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        buffer = DataBuffer()
+        try:
+            error = await self._receive_data(buffer)
+            if error:
+                await self.push(error)
+                self._set_post_data_state()
+                return
+            content = buffer.content()
+        finally:
+            buffer.close()
+
+        self.envelope.content = self.envelope.original_content = content
+        status = await self._call_handler_hook('DATA')
+        self._set_post_data_state()
+        await self.push('250 OK' if status is MISSING else status)
+
+    async def _receive_data(self, buffer: DataBuffer) -> str | None:
+        """
+        Read DATA up to the terminating lone dot into buffer, undoing dot-stuffing.
+        Returns the error reply if the message has to be rejected.
+        """
+        limit = self.data_size_limit
+        error = None
+        # length of the current line so far; lines longer than the reader's limit arrive in pieces
+        line_length = 0
+        while self.transport is not None:
+            try:
+                line = await self._reader.readuntil(b'\r\n')
+            except asyncio.CancelledError:
+                logging.info("Connection lost during DATA")
+                self._writer.close()
+                raise
+            except asyncio.LimitOverrunError as e:
+                # drain the overlong line; the client still has to send the rest
+                error = error or "500 Line too long (see RFC5321 4.5.3.1.6)"
+                line = await self._reader.read(e.consumed)
+
+            line_start = not line_length
+            if line_start and line == b'.\r\n':
+                break
+            if error is None and limit and buffer.size + len(line) > limit:
+                error = "552 Error: Too much mail data"
+            line_length += len(line)
+            if line.endswith(b'\r\n'):
+                # like aiosmtpd, also check the joined line in case the pieces got past the reader's limit
+                if error is None and line_length > self.line_length_limit:
+                    error = "500 Line too long (see RFC5321 4.5.3.1.6)"
+                line_length = 0
+            if error is None:
+                buffer.write(line[1:] if line_start and line.startswith(b'.') else line)
+        return error
+
     # Override STARTTLS to catch SSL handshake errors
     async def smtp_STARTTLS(self, arg: str) -> None:
         try:
@@ -8,6 +8,19 @@ def load_env(name, default=None, sanitize=lambda x: x, valid_values=None, conver
         raise ValueError(f"Invalid {name}: {value}")
     return convert(value)
 
+# Parse a comma-separated list of port:mode listeners, e.g. "8025:starttls,8465:implicit"
+def parse_listeners(value: str) -> list[tuple[int, str]]:
+    listeners = []
+    for item in value.split(','):
+        port, _, mode = item.strip().partition(':')
+        mode = mode.strip().lower() or 'starttls'
+        if not port.strip().isdigit() or not 0 < int(port) < 65536 or mode not in ('starttls', 'optional', 'implicit'):
+            raise ValueError(f"Invalid LISTENERS entry: {item.strip()}")
+        if any(int(port) == existing for existing, _ in listeners):
+            raise ValueError(f"Duplicate port in LISTENERS: {port.strip()}")
+        listeners.append((int(port), mode))
+    return listeners
+
 # Configuration
 LOG_LEVEL = load_env(
     name='LOG_LEVEL',
@@ -32,6 +45,11 @@ SERVER_GREETING = load_env(
     name='SERVER_GREETING', 
     default='Microsoft Graph SMTP OAuth Relay'
 )
+LISTENERS = load_env(
+    name='LISTENERS',
+    default='8025:starttls' if REQUIRE_TLS else '8025:optional',
+    convert=parse_listeners
+)
 TLS_CERT_FILEPATH = load_env(
     name='TLS_CERT_FILEPATH',
     default='certs/cert.pem'
@@ -44,6 +62,16 @@ TLS_CIPHER_SUITE = load_env(
     name='TLS_CIPHER_SUITE',
     default=None # Make it optional
 )
+TLS_RELOAD_INTERVAL = load_env(
+    name='TLS_RELOAD_INTERVAL',
+    default='3600',
+    convert=int
+)
+TLS_SESSION_TICKETS = load_env(
+    name='TLS_SESSION_TICKETS',
+    default='2',
+    convert=int
+)
 USERNAME_DELIMITER = load_env(
     name='USERNAME_DELIMITER',
     default='@',
@@ -72,3 +100,254 @@ AZURE_TABLES_FORCE_USAGE = load_env(
     sanitize=lambda x: x.lower(),
     convert=lambda x: x == 'true'
 )
+TOKEN_CACHE_SIZE = load_env(
+    name='TOKEN_CACHE_SIZE',
+    default='1024',
+    convert=int
+)
+TOKEN_CACHE_EXPIRY_MARGIN = load_env(
+    name='TOKEN_CACHE_EXPIRY_MARGIN',
+    default='300',
+    convert=int
+)
+TOKEN_REFRESH_WINDOW = load_env(
+    name='TOKEN_REFRESH_WINDOW',
+    default='600',
+    convert=int
+)
+TOKEN_REFRESH_MIN_USES = load_env(
+    name='TOKEN_REFRESH_MIN_USES',
+    default='2',
+    convert=int
+)
+TOKEN_REFRESH_IDLE_TIMEOUT = load_env(
+    name='TOKEN_REFRESH_IDLE_TIMEOUT',
+    default='900',
+    convert=int
+)
+TOKEN_REFRESH_MAX_CREDENTIALS = load_env(
+    name='TOKEN_REFRESH_MAX_CREDENTIALS',
+    default='100',
+    convert=int
+)
+SESSION_TOKEN_RENEW_WINDOW = load_env(
+    name='SESSION_TOKEN_RENEW_WINDOW',
+    default='300',
+    convert=int
+)
+HTTP_POOL_SIZE = load_env(
+    name='HTTP_POOL_SIZE',
+    default='100',
+    convert=int
+)
+HTTP_KEEPALIVE_CONNECTIONS = load_env(
+    name='HTTP_KEEPALIVE_CONNECTIONS',
+    default='20',
+    convert=int
+)
+HTTP_KEEPALIVE_EXPIRY = load_env(
+    name='HTTP_KEEPALIVE_EXPIRY',
+    default='60',
+    convert=float
+)
+HTTP_CONNECT_TIMEOUT = load_env(
+    name='HTTP_CONNECT_TIMEOUT',
+    default='10',
+    convert=float
+)
+HTTP_TIMEOUT = load_env(
+    name='HTTP_TIMEOUT',
+    default='120',
+    convert=float
+)
+HTTP2 = load_env(
+    name='HTTP2',
+    default='true',
+    valid_values=['true', 'false'],
+    sanitize=lambda x: x.lower(),
+    convert=lambda x: x == 'true'
+)
+AZURE_TABLES_CACHE_SIZE = load_env(
+    name='AZURE_TABLES_CACHE_SIZE',
+    default='10000',
+    convert=int
+)
+AZURE_TABLES_CACHE_TTL = load_env(
+    name='AZURE_TABLES_CACHE_TTL',
+    default='300',
+    convert=int
+)
+AZURE_TABLES_NEGATIVE_CACHE_TTL = load_env(
+    name='AZURE_TABLES_NEGATIVE_CACHE_TTL',
+    default='30',
+    convert=int
+)
+AZURE_TABLES_SNAPSHOT = load_env(
+    name='AZURE_TABLES_SNAPSHOT',
+    default='false',
+    valid_values=['true', 'false'],
+    sanitize=lambda x: x.lower(),
+    convert=lambda x: x == 'true'
+)
+AZURE_TABLES_SNAPSHOT_INTERVAL = load_env(
+    name='AZURE_TABLES_SNAPSHOT_INTERVAL',
+    default='60',
+    convert=int
+)
+AZURE_TABLES_SNAPSHOT_FULL_INTERVAL = load_env(
+    name='AZURE_TABLES_SNAPSHOT_FULL_INTERVAL',
+    default='3600',
+    convert=int
+)
+GRAPH_LARGE_MESSAGE_THRESHOLD = load_env(
+    name='GRAPH_LARGE_MESSAGE_THRESHOLD',
+    default='0',
+    convert=int
+)
+MAX_MESSAGE_SIZE = load_env(
+    name='MAX_MESSAGE_SIZE',
+    default='33554432',
+    convert=int
+)
+DATA_SPILL_THRESHOLD = load_env(
+    name='DATA_SPILL_THRESHOLD',
+    default='1048576',
+    convert=int
+)
+MAX_SESSIONS = load_env(
+    name='MAX_SESSIONS',
+    default='0',
+    convert=int
+)
+MAX_SESSIONS_PER_IP = load_env(
+    name='MAX_SESSIONS_PER_IP',
+    default='0',
+    convert=int
+)
+AUTH_FAILURE_LIMIT = load_env(
+    name='AUTH_FAILURE_LIMIT',
+    default='0',
+    convert=int
+)
+AUTH_FAILURE_WINDOW = load_env(
+    name='AUTH_FAILURE_WINDOW',
+    default='300',
+    convert=int
+)
+AUTH_FAILED_CREDENTIALS_TTL = load_env(
+    name='AUTH_FAILED_CREDENTIALS_TTL',
+    default='120',
+    convert=int
+)
+SPOOL_DIR = load_env(
+    name='SPOOL_DIR',
+    default=None  # Make it optional
+)
+SPOOL_WORKERS = load_env(
+    name='SPOOL_WORKERS',
+    default='32',
+    convert=int
+)
+SPOOL_RETRY_BASE = load_env(
+    name='SPOOL_RETRY_BASE',
+    default='30',
+    convert=int
+)
+SPOOL_RETRY_MAX = load_env(
+    name='SPOOL_RETRY_MAX',
+    default='3600',
+    convert=int
+)
+SPOOL_MAX_AGE = load_env(
+    name='SPOOL_MAX_AGE',
+    default='86400',
+    convert=int
+)
+SPOOL_STORE_TOKEN = load_env(
+    name='SPOOL_STORE_TOKEN',
+    default='false',
+    valid_values=['true', 'false'],
+    sanitize=lambda x: x.lower(),
+    convert=lambda x: x == 'true'
+)
+GRAPH_MAX_CONCURRENCY = load_env(
+    name='GRAPH_MAX_CONCURRENCY',
+    default='64',
+    convert=int
+)
+GRAPH_MAILBOX_CONCURRENCY = load_env(
+    name='GRAPH_MAILBOX_CONCURRENCY',
+    default='4',
+    convert=int
+)
+GRAPH_TENANT_RATE = load_env(
+    name='GRAPH_TENANT_RATE',
+    default='0',
+    convert=float
+)
+GRAPH_TENANT_BURST = load_env(
+    name='GRAPH_TENANT_BURST',
+    default='20',
+    convert=int
+)
+GRAPH_MAILBOX_RATE = load_env(
+    name='GRAPH_MAILBOX_RATE',
+    default='0',
+    convert=float
+)
+GRAPH_MAILBOX_BURST = load_env(
+    name='GRAPH_MAILBOX_BURST',
+    default='10',
+    convert=int
+)
+GRAPH_THROTTLE_TIMEOUT = load_env(
+    name='GRAPH_THROTTLE_TIMEOUT',
+    default='60',
+    convert=int
+)
+GRAPH_BATCH_SIZE = load_env(
+    name='GRAPH_BATCH_SIZE',
+    default='0',
+    # Graph accepts at most 20 requests per batch
+    convert=lambda x: min(int(x), 20)
+)
+GRAPH_BATCH_WINDOW = load_env(
+    name='GRAPH_BATCH_WINDOW',
+    default='0.05',
+    convert=float
+)
+MONITORING_PORT = load_env(
+    name='MONITORING_PORT',
+    default='0',
+    convert=int
+)
+WORKERS = load_env(
+    name='WORKERS',
+    default='1',
+    convert=int
+)
+MIME_POOL_SIZE = load_env(
+    name='MIME_POOL_SIZE',
+    default='0',
+    convert=int
+)
+MIME_POOL_THRESHOLD = load_env(
+    name='MIME_POOL_THRESHOLD',
+    default='1048576',
+    convert=int
+)
+SHUTDOWN_TIMEOUT = load_env(
+    name='SHUTDOWN_TIMEOUT',
+    default='25',
+    convert=int
+)
+AZURE_AUTHORITY_HOST = load_env(
+    name='AZURE_AUTHORITY_HOST',
+    default='https://login.microsoftonline.com',
+    sanitize=lambda x: (x if '://' in x else f"https://{x}").rstrip('/')
+)
+GRAPH_ENDPOINT = load_env(
+    name='GRAPH_ENDPOINT',
+    default='https://graph.microsoft.com',
+    sanitize=lambda x: x.rstrip('/')
+)
@@ -0,0 +1,321 @@
+import base64
+import logging
+import time
+import httpx
+from email.utils import parsedate_to_datetime
+from typing import Iterator
+
+import http_client
+from mime import MimePart, decoded_chunks, decoded_size, mime_skeleton, walk_parts
+from env import GRAPH_ENDPOINT, GRAPH_LARGE_MESSAGE_THRESHOLD
+
+
+GRAPH_URL = f"{GRAPH_ENDPOINT}/v1.0"
+
+# Attachments up to this size are added to the draft in a single request; larger
+# ones go through an upload session (Graph caps direct attachments at 3 MB)
+_DIRECT_ATTACHMENT_LIMIT = 3 * 1024 * 1024
+
+# Upload session chunks must be a multiple of 320 KiB and at most 60 MiB
+_UPLOAD_CHUNK_SIZE = 10 * 320 * 1024
+
+
+class SendResult:
+    """
+    Outcome of a send attempt. Truthy if the message was accepted by Graph.
+    retryable is set for throttling, server errors and transport failures;
+    retry_after holds the delay Graph asked for, in seconds, if any, and
+    throttle_scope the scope of the exceeded limit (e.g. 'Tenant') if Graph
+    reported one.
+    """
+
+    __slots__ = ('success', 'status_code', 'retryable', 'retry_after', 'throttle_scope')
+
+    def __init__(self, success: bool, status_code: int | None = None, retryable: bool = False, retry_after: float | None = None, throttle_scope: str | None = None):
+        self.success = success
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.throttle_scope = throttle_scope
+
+    def __bool__(self) -> bool:
+        return self.success
+
+    def __repr__(self) -> str:
+        return f"SendResult(success={self.success}, status_code={self.status_code}, retryable={self.retryable}, retry_after={self.retry_after})"
+
+
+def _retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _throttle_scope(value: str | None) -> str | None:
+    # x-ms-throttle-scope is <scope>/<limit>/<application id>/<resource id>
+    if not value:
+        return None
+    return value.split('/', 1)[0] or None
+
+
+def _failed_result(response: httpx.Response) -> SendResult:
+    status_code = response.status_code
+    return SendResult(
+        success=False,
+        status_code=status_code,
+        retryable=status_code == 429 or status_code >= 500,
+        retry_after=_retry_after(response.headers.get('Retry-After')),
+        throttle_scope=_throttle_scope(response.headers.get('x-ms-throttle-scope'))
+    )
+
+
+def is_large_message(size: int) -> bool:
+    """
+    Return True if a message of this size is sent through the draft/upload session path.
+    """
+    return bool(GRAPH_LARGE_MESSAGE_THRESHOLD) and size > GRAPH_LARGE_MESSAGE_THRESHOLD
+
+
+async def send_email(access_token: str, body: bytes, from_email: str) -> SendResult:
+    if is_large_message(len(body)):
+        return await send_large_email(access_token, body, from_email)
+
+    url = f"{GRAPH_URL}/users/{from_email}/sendMail"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "text/plain"
+    }
+    
+    try:
+        data = base64.b64encode(body)
+        logging.debug(f"Sending email from {from_email}")
+        
+        response = await http_client.get_client().post(url, content=data, headers=headers)
+        if response.status_code == 202:
+            logging.info("Email sent successfully!")
+            return SendResult(success=True, status_code=response.status_code)
+        else:
+            logging.error(f"Failed to send email: Status code {response.status_code}")
+            logging.error(f"Response body: {response.text}")
+            return _failed_result(response)
+    except httpx.TransportError as e:
+        logging.error(f"Transport error while sending email: {str(e)}")
+        return SendResult(success=False, retryable=True)
+    except Exception as e:
+        logging.exception(f"Exception while sending email: {str(e)}")
+        return SendResult(success=False)
+
+
+async def send_batch(access_token: str, messages: list[tuple[bytes, str]]) -> list[SendResult]:
+    """
+    Send several messages, given as (body, from_email) pairs, in one JSON batch
+    request. Graph runs the contained sendMail requests independently, so every
+    message gets its own result, in the order given.
+    """
+    requests = [
+        {
+            "id": str(index),
+            "method": "POST",
+            "url": f"/users/{from_email}/sendMail",
+            "headers": {"Content-Type": "text/plain"},
+            # batch bodies that are not JSON are base64 encoded; the sendMail body itself is base64 MIME
+            "body": base64.b64encode(base64.b64encode(body)).decode('ascii')
+        }
+        for index, (body, from_email) in enumerate(messages)
+    ]
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+    try:
+        logging.debug(f"Sending {len(messages)} emails in one batch")
+        response = await http_client.get_client().post(f"{GRAPH_URL}/$batch", json={"requests": requests}, headers=headers)
+        if response.status_code != 200:
+            logging.error(f"Failed to send email batch: Status code {response.status_code}")
+            logging.error(f"Response body: {response.text}")
+            return [_failed_result(response)] * len(messages)
+        responses = {item.get("id"): item for item in response.json().get("responses", [])}
+    except httpx.TransportError as e:
+        logging.error(f"Transport error while sending email batch: {str(e)}")
+        return [SendResult(success=False, retryable=True)] * len(messages)
+    except Exception as e:
+        logging.exception(f"Exception while sending email batch: {str(e)}")
+        return [SendResult(success=False)] * len(messages)
+
+    results = []
+    for index, (body, from_email) in enumerate(messages):
+        item = responses.get(str(index))
+        if item is None:
+            logging.error(f"Batch response has no result for the email from {from_email}")
+            results.append(SendResult(success=False, retryable=True))
+            continue
+
+        status_code = int(item.get("status", 0))
+        if status_code == 202:
+            results.append(SendResult(success=True, status_code=status_code))
+            continue
+
+        logging.error(f"Failed to send email from {from_email} in batch: Status code {status_code}")
+        logging.error(f"Response body: {item.get('body')}")
+        item_headers = {name.lower(): value for name, value in (item.get("headers") or {}).items()}
+        results.append(SendResult(
+            success=False,
+            status_code=status_code,
+            retryable=status_code == 429 or status_code >= 500,
+            retry_after=_retry_after(item_headers.get('retry-after')),
+            throttle_scope=_throttle_scope(item_headers.get('x-ms-throttle-scope'))
+        ))
+    logging.info(f"Email batch sent: {sum(1 for result in results if result)} of {len(results)} accepted")
+    return results
+
+
+def _body_part(parts: list[MimePart]) -> MimePart | None:
+    """
+    Return the part Graph should use as the message body: the first HTML part
+    that is not an attachment, or else the first plain text one.
+    """
+    candidates = [
+        part for part in parts
+        if part.headers.get_content_type() in ('text/html', 'text/plain')
+        and part.headers.get_content_disposition() != 'attachment'
+    ]
+    for part in candidates:
+        if part.headers.get_content_subtype() == 'html':
+            return part
+    return candidates[0] if candidates else None
+
+
+def _is_attachment(part: MimePart, body: MimePart | None) -> bool:
+    """
+    Return True for every part that Graph has to receive as an attachment, i.e.
+    all leaf parts except the message body and its alternative renderings.
+    """
+    if part is body:
+        return False
+    headers = part.headers
+    return not (part.in_alternative and headers.get_content_maintype() == 'text' and headers.get_content_disposition() is None)
+
+
+def _upload_chunks(content: bytes, part: MimePart) -> Iterator[bytes]:
+    # upload sessions need chunks of exactly _UPLOAD_CHUNK_SIZE, except the last
+    buffer = bytearray()
+    for decoded in decoded_chunks(content, part):
+        buffer += decoded
+        while len(buffer) >= _UPLOAD_CHUNK_SIZE:
+            yield bytes(buffer[:_UPLOAD_CHUNK_SIZE])
+            del buffer[:_UPLOAD_CHUNK_SIZE]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _add_attachment(access_token: str, message_url: str, content: bytes, part: MimePart):
+    headers = part.headers
+    content_type = headers.get_content_type()
+    name = headers.get_filename() or ('message.eml' if content_type == 'message/rfc822' else 'attachment')
+    is_inline = headers.get_content_disposition() == 'inline'
+    content_id = str(headers.get('Content-ID', '')).strip('<> ') or None
+    size = decoded_size(content, part)
+    auth_headers = {"Authorization": f"Bearer {access_token}"}
+    client = http_client.get_client()
+
+    if size <= _DIRECT_ATTACHMENT_LIMIT:
+        response = await client.post(f"{message_url}/attachments", headers=auth_headers, json={
+            "@odata.type": "#microsoft.graph.fileAttachment",
+            "name": name,
+            "contentType": content_type,
+            "contentBytes": base64.b64encode(b''.join(decoded_chunks(content, part))).decode('ascii'),
+            "isInline": is_inline,
+            "contentId": content_id,
+        })
+        response.raise_for_status()
+        return
+
+    response = await client.post(f"{message_url}/attachments/createUploadSession", headers=auth_headers, json={
+        "AttachmentItem": {
+            "attachmentType": "file",
+            "name": name,
+            "size": size,
+            "contentType": content_type,
+            "isInline": is_inline,
+            "contentId": content_id,
+        }
+    })
+    response.raise_for_status()
+    upload_url = response.json()["uploadUrl"]
+
+    # The upload URL is pre-authenticated; Graph rejects requests that also carry a bearer token
+    start = 0
+    for chunk in _upload_chunks(content, part):
+        response = await client.put(upload_url, content=chunk, headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Range": f"bytes {start}-{start + len(chunk) - 1}/{size}",
+        })
+        response.raise_for_status()
+        start += len(chunk)
+    logging.debug(f"Uploaded attachment '{name}' ({size} bytes) in an upload session")
+
+
+async def send_large_email(access_token: str, body: bytes, from_email: str) -> SendResult:
+    """
+    Send a message that is too large for a single sendMail request: create a draft
+    from the message's headers and body part, add each attachment to it (through
+    an upload session if large), then send the draft. Requires Mail.ReadWrite on
+    the mailbox.
+
+    The draft is created from MIME, so all headers (Message-ID, In-Reply-To,
+    References, ...) are kept. Parts are located in the raw bytes without
+    building the MIME tree, and attachments are decoded one block at a time,
+    so memory use beyond body does not grow with the message size.
+    """
+    headers = {"Authorization": f"Bearer {access_token}"}
+    client = http_client.get_client()
+    message_url = None
+
+    try:
+        parts = list(walk_parts(body))
+        body_part = _body_part(parts)
+        attachments = [part for part in parts if _is_attachment(part, body_part)]
+        logging.debug(f"Sending large email ({len(body)} bytes, {len(attachments)} attachments) from {from_email}")
+
+        response = await client.post(
+            f"{GRAPH_URL}/users/{from_email}/messages",
+            headers={**headers, "Content-Type": "text/plain"},
+            content=base64.b64encode(mime_skeleton(body, body_part))
+        )
+        response.raise_for_status()
+        message_url = f"{GRAPH_URL}/users/{from_email}/messages/{response.json()['id']}"
+
+        for part in attachments:
+            await _add_attachment(access_token, message_url, body, part)
+
+        response = await client.post(f"{message_url}/send", headers=headers)
+        response.raise_for_status()
+        logging.info("Email sent successfully!")
+        return SendResult(success=True, status_code=response.status_code)
+    except Exception as e:
+        if isinstance(e, httpx.HTTPStatusError):
+            logging.error(f"Failed to send large email: Status code {e.response.status_code}")
+            logging.error(f"Response body: {e.response.text}")
+            result = _failed_result(e.response)
+        elif isinstance(e, httpx.TransportError):
+            logging.error(f"Transport error while sending large email: {str(e)}")
+            result = SendResult(success=False, retryable=True)
+        else:
+            logging.exception(f"Exception while sending large email: {str(e)}")
+            result = SendResult(success=False)
+
+        # don't leave half-built drafts behind in the sender's mailbox
+        if message_url:
+            try:
+                await client.delete(message_url, headers=headers)
+            except Exception as e:
+                logging.warning(f"Failed to delete draft after failed send: {str(e)}")
+        return result
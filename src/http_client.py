@@ -0,0 +1,43 @@
+import httpx
+
+from env import (
+    HTTP_POOL_SIZE,
+    HTTP_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_TIMEOUT,
+    HTTP2
+)
+
+
+_client: httpx.AsyncClient | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Return the shared HTTP client used for Entra ID and Graph requests.
+    The client keeps a pool of keep-alive connections per host and negotiates
+    HTTP/2 via ALPN when HTTP2 is enabled. Created on first use.
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=HTTP2,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return _client
+
+
+async def close():
+    """
+    Close the shared HTTP client and its pooled connections.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,32 +1,64 @@
 import asyncio
 import logging
-import requests
 import base64
+import os
 import re
+import signal
+import sys
+import time
 import uuid
-from email import message_from_bytes, policy
-from quopri import decodestring
 
 from custom import CustomController
 from aiosmtpd.smtp import AuthResult
 
 import sslContext
 import azure_table
+import http_client
+import metrics
+import monitoring
+import ratelimit
+import supervisor
+from graph import is_large_message
+import mime
+from oauth import SessionToken, is_credential_error, refresh_tokens
+from spool import Spool
+from throttle import scheduler
 from env import (
     LOG_LEVEL,
     TLS_SOURCE,
-    REQUIRE_TLS,
     SERVER_GREETING,
+    LISTENERS,
     TLS_CERT_FILEPATH,
     TLS_KEY_FILEPATH,
-    TLS_CIPHER_SUITE,
+    TLS_RELOAD_INTERVAL,
     USERNAME_DELIMITER,
     AZURE_KEY_VAULT_URL,
     AZURE_KEY_VAULT_CERT_NAME,
-    AZURE_TABLES_FORCE_USAGE
+    AZURE_TABLES_URL,
+    AZURE_TABLES_FORCE_USAGE,
+    AZURE_TABLES_SNAPSHOT,
+    TOKEN_CACHE_SIZE,
+    TOKEN_REFRESH_WINDOW,
+    SPOOL_DIR,
+    MONITORING_PORT,
+    WORKERS,
+    SHUTDOWN_TIMEOUT,
+    GRAPH_MAX_CONCURRENCY,
+    MAX_MESSAGE_SIZE
 )
 
 
+# Keep references to long-running tasks so they are not garbage collected
+background_tasks: set[asyncio.Task] = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
 
 
 def decode_uuid_or_base64url(input_str: str) -> str:
@@ -48,7 +80,7 @@ def decode_uuid_or_base64url(input_str: str) -> str:
 
 
 
-def parse_username(username: str) -> tuple[str, str, str|None]:
+async def parse_username(username: str) -> tuple[str, str, str|None]:
     """
     Parse the username to extract tenant_id and client_id.
     The expected format is: tenant_id{USERNAME_DELIMITER}client_id{. optional_tld}
@@ -69,7 +101,8 @@ def parse_username(username: str) -> tuple[str, str, str|None]:
     
     # check if the second part hints a user stored in the lookup table
     if parts[1] == 'lookup':
-        return azure_table.lookup_user(parts[0])
+        with metrics.AUTH_DURATION.labels('table_lookup').time():
+            return await azure_table.lookup_user(parts[0])
 
     # else return both parts decoded
     tenant_id = decode_uuid_or_base64url(parts[0])
@@ -77,101 +110,21 @@ def parse_username(username: str) -> tuple[str, str, str|None]:
 
     # If AZURE_TABLES_FORCE_USAGE is enabled, verify the user exists in the table
     if AZURE_TABLES_FORCE_USAGE:
-        from_email = azure_table.verify_user_in_table(tenant_id, client_id)
+        with metrics.AUTH_DURATION.labels('table_lookup').time():
+            from_email = await azure_table.verify_user_in_table(tenant_id, client_id)
         return tenant_id, client_id, from_email
 
     return tenant_id, client_id, None
 
 
-def get_access_token(tenant_id: str, client_id: str, client_secret: str) -> str:
-    data = {
-        "grant_type": "client_credentials",
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "scope": "https://graph.microsoft.com/.default"
-    }
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    
-    try:
-        response = requests.post(
-            url=f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token", 
-            data=data, 
-            headers=headers
-        )
-        response.raise_for_status()
-        return response.json().get("access_token")
-    except requests.RequestException as e:
-        logging.error(f"OAuth token request failed: {str(e)}")
-        if hasattr(e, 'response') and e.response:
-            logging.error(f"Response status: {e.response.status_code}, Response body: {e.response.text}")
-        raise
-
-def _sanitize_mime_encoding(raw_message: bytes) -> bytes:
-    """
-    Convert quoted-printable MIME parts to base64 before sending to Graph API.
-    """
-
-    def _convert_parts(msg, location: str = 'root') -> bool:
-        modified = False
-        if msg.is_multipart():
-            for index, part in enumerate(msg.get_payload()):
-                if _convert_parts(part, f"{location}.{index}"):
-                    modified = True
-        else:
-            if msg.get('Content-Transfer-Encoding', '').lower().strip() == 'quoted-printable':
-                logging.debug(
-                    f"Converting quoted-printable MIME part at {location} "
-                    f"(content-type={msg.get_content_type()})"
-                )
-                qp_payload = msg.get_payload(decode=False)
-                if isinstance(qp_payload, str):
-                    decoded = decodestring(qp_payload.encode('ascii', errors='surrogateescape'))
-                else:
-                    decoded = decodestring(qp_payload)
-                msg.set_payload(base64.encodebytes(decoded).decode('ascii'))
-                del msg['Content-Transfer-Encoding']
-                msg['Content-Transfer-Encoding'] = 'base64'
-                modified = True
-        return modified
-
-    try:
-        msg = message_from_bytes(raw_message, policy=policy.compat32)
-        if _convert_parts(msg):
-            logging.info("Sanitized MIME encoding")
-            return msg.as_bytes()
-        logging.debug("No quoted-printable MIME parts found; message unchanged")
-    except Exception:
-        logging.exception("Failed to sanitize MIME encoding; sending original raw message")
-    return raw_message
-
-
-def send_email(access_token: str, body: bytes, from_email: str) -> bool:
-    url = f"https://graph.microsoft.com/v1.0/users/{from_email}/sendMail"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "text/plain"
-    }
-    
-    try:
-        data = base64.b64encode(_sanitize_mime_encoding(body))
-        logging.debug(f"Sending email from {from_email}")
-        
-        response = requests.post(url, data=data, headers=headers)
-        if response.status_code == 202:
-            logging.info("Email sent successfully!")
-            return True
-        else:
-            logging.error(f"Failed to send email: Status code {response.status_code}")
-            logging.error(f"Response body: {response.text}")
-            return False
-    except Exception as e:
-        logging.exception(f"Exception while sending email: {str(e)}")
-        return False
-
-
-
 class Authenticator:
-    def __call__(self, server, session, envelope, mechanism, auth_data):
+    async def __call__(self, server, session, envelope, mechanism, auth_data):
+        with metrics.AUTH_DURATION.labels('total').time():
+            result = await self.authenticate(server, session, envelope, mechanism, auth_data)
+        metrics.AUTH_RESULTS.labels('success' if result.success else 'failure').inc()
+        return result
+
+    async def authenticate(self, server, session, envelope, mechanism, auth_data):
         try:
             # Only support LOGIN and PLAIN mechanisms
             if mechanism not in ('LOGIN', 'PLAIN'):
@@ -189,21 +142,45 @@ class Authenticator:
                 logging.error(f"Failed to decode login string: {str(e)}")
                 return AuthResult(success=False, handled=False, message="535 5.7.8 Invalid authentication credentials encoding")
             
+            client_ip = str(session.peer[0] if isinstance(session.peer, tuple) else session.peer)
+            credential = ratelimit.credential_key(login_str, auth_data.password)
+            # credentials that recently worked are never locked out by others' failures
+            if not ratelimit.succeeded_credentials.get(credential) and ratelimit.auth_blocked(client_ip, login_str):
+                logging.warning(f"Too many failed AUTH attempts from {client_ip} or for '{login_str}'; rejecting")
+                metrics.REJECTED.labels('auth_failures').inc()
+                return AuthResult(success=False, handled=False, message="454 4.7.0 Too many failed authentication attempts, try again later")
+
+            # credentials that failed recently are rejected without a table lookup or token request
+            if ratelimit.failed_credentials.get(credential):
+                logging.warning(f"Rejecting recently failed credentials for '{login_str}' from {client_ip}")
+                metrics.REJECTED.labels('failed_credentials').inc()
+                ratelimit.record_auth_failure(client_ip, login_str)
+                return AuthResult(success=False, handled=False, message="535 5.7.8 Authentication failed")
+
             # Parse tenant_id and client_id from login string using the configured format
             try:
-                tenant_id, client_id, from_email = parse_username(login_str)
+                tenant_id, client_id, from_email = await parse_username(login_str)
             except ValueError as e:
                 logging.error(str(e))
+                ratelimit.record_auth_failure(client_ip, login_str, credential)
                 return AuthResult(success=False, handled=False, message=f"535 5.7.8 {str(e)}")
                 
-            client_secret = auth_data.password
             session.lookup_from_email = from_email
+            session.tenant_id = tenant_id
 
+            # kept on the session, so long-lived connections can renew the token
+            token = SessionToken(tenant_id, client_id, auth_data.password)
             try:
-                session.access_token = get_access_token(tenant_id, client_id, client_secret)
+                with metrics.AUTH_DURATION.labels('token_fetch').time():
+                    await token.fetch()
+                session.token = token
+                ratelimit.record_auth_success(credential)
                 return AuthResult(success=True)
             except Exception as e:
                 logging.error(f"Authentication failed: {str(e)}")
+                # transient failures (Entra ID unreachable, server errors) do not count against the client
+                if is_credential_error(e):
+                    ratelimit.record_auth_failure(client_ip, login_str, credential)
                 return AuthResult(success=False, handled=False, message="535 5.7.8 Authentication failed")
                 
         except Exception as e:
@@ -212,164 +189,368 @@ class Authenticator:
 
 
 class Handler:
+    def __init__(self, spool: Spool | None = None):
+        self.spool = spool
+        # False until startup has finished; connections are answered with 421 meanwhile
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    # Called by CustomSMTP from an accepted MAIL until the transaction ends
+    # (DATA done, RSET, EHLO or the connection is lost), so a drain also waits
+    # for messages whose content is still being received
+    def begin_transaction(self):
+        self.in_flight += 1
+        self._idle.clear()
+
+    def end_transaction(self):
+        self.in_flight -= 1
+        if not self.in_flight:
+            self._idle.set()
+
     async def handle_DATA(self, server, session, envelope):
+        with metrics.DATA_DURATION.labels('total').time():
+            return await self.process_DATA(server, session, envelope)
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Stop accepting new messages and wait up to timeout seconds for the open
+        transactions to finish. Returns False if some did not finish in time.
+        """
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def process_DATA(self, server, session, envelope):
         logging.debug(f"SMTP envelope: mail_from={envelope.mail_from}, rcpt_tos={envelope.rcpt_tos}")
 
-        if not hasattr(session, 'access_token'):
+        if getattr(session, 'token', None) is None:
             logging.error("No access token available in session")
             return "530 5.7.0 Authentication required"
 
         try:
-            raw_envelope = message_from_bytes(envelope.content)
+            access_token = await session.token.get()
+        except Exception as e:
+            logging.error(f"Could not renew the session's access token: {str(e)}")
+            return "451 4.7.0 Temporary authentication failure, please retry"
+
+        # When lookup_from_email is configured it replaces the From header and the Graph sender
+        from_override = getattr(session, 'lookup_from_email', None)
+        if not from_override:
+            logging.debug("No from-override configured; using envelope.mail_from")
+        mail_from = from_override or envelope.mail_from
+        metrics.MESSAGE_SIZE.observe(len(envelope.content))
+
+        # apply any necessary fixes for known issues; the large-message path
+        # decodes every part itself, so it needs no encoding conversion
+        try:
+            with metrics.DATA_DURATION.labels('mime').time():
+                body = await mime.prepare_message_async(
+                    envelope.content,
+                    envelope.rcpt_tos,
+                    from_override,
+                    sanitize_encoding=not is_large_message(len(envelope.content))
+                )
         except Exception as e:
             logging.exception("Failed to parse incoming message bytes")
             return "554 Transaction failed"
 
-        # apply any necessary fixes for known issues
-        fixes_applied = False
-        fixes_applied |= self._fix_missing_bcc(raw_envelope, envelope.rcpt_tos)
-        override_applied, mail_from = self._apply_from_override(raw_envelope, session, envelope.mail_from)
-        fixes_applied |= override_applied
+        # in store-and-forward mode, acknowledge once the message is safely on disk
+        if self.spool is not None:
+            try:
+                with metrics.DATA_DURATION.labels('spool').time():
+                    message_id = await self.spool.enqueue(body, mail_from, session.tenant_id, session.token)
+            except Exception as e:
+                logging.exception(f"Failed to spool message: {str(e)}")
+                return "451 4.3.0 Temporary failure, please retry"
+            logging.info(f"DATA command accepted into spool as {message_id}")
+            return "250 OK"
 
-        if fixes_applied:
-            logging.debug("Applied fixes to email headers before sending")
-            success = send_email(session.access_token, raw_envelope.as_bytes(), mail_from)
-        else:
-            success = send_email(session.access_token, envelope.content, envelope.mail_from)
+        with metrics.DATA_DURATION.labels('graph').time():
+            result = await scheduler.send(session.tenant_id, access_token, body, mail_from)
 
-        if success:
+        if result:
             logging.info("DATA command processed successfully")
             return "250 OK"
 
+        # throttling and transient Graph errors are worth a retry by the client
+        if result.retryable:
+            logging.error("DATA command failed temporarily during send_email")
+            return "451 4.3.0 Temporary failure, please retry"
+
         logging.error("DATA command failed during send_email")
         return "554 Transaction failed"
 
-    def _fix_missing_bcc(self, raw_envelope, rcpt_tos) -> bool:
-        """Ensure Bcc header contains any recipients missing from To/Cc.
-        Return True if a fix was applied, False otherwise.
 
-        Issue #82: some clients do not include Bcc recipients in the headers
-        at all, which causes Graph to drop them. The workaround is to compute
-        which rcpt_tos are not already in To/Cc and add them as a Bcc header.
-        """
 
-        to_headers = raw_envelope.get_all('To', [])
-        cc_headers = raw_envelope.get_all('Cc', [])
-        total_headers = len(to_headers) + len(cc_headers)
-        logging.debug(f"Headers count - To: {len(to_headers)}, Cc: {len(cc_headers)}")
+# Event loop lag at which the relay counts as fully busy, for the saturation signal
+_LOOP_LAG_SATURATED = 0.1
 
-        if len(rcpt_tos) <= total_headers:
-            logging.debug("No missing recipients detected; skipping Bcc fixup")
-            return False
+# How often the saturation gauge is updated
+_SATURATION_INTERVAL = 1
 
-        header_recipients = set(to_headers + cc_headers)
-        missing = set(rcpt_tos) - header_recipients
-        if not missing:
-            logging.debug("Mismatch between rcpt_tos and headers, but no missing recipients")
-            return False
-        
-        logging.info(f"Adding Bcc header for missing recipients: {sorted(missing)}")
-        # preserve any existing Bcc header by appending if present
-        existing_bcc = raw_envelope.get_all('Bcc', [])
-        combined = list(existing_bcc) + sorted(missing)
-        raw_envelope['Bcc'] = ", ".join(combined)
-        return True
-
-    def _apply_from_override(self, raw_envelope, session, default_mail_from) -> tuple[bool, str]:
-        """When lookup_from_email is configured replace the From header.
-        Returns a a tuple of (was_overridden, new_mail_from). If no override was applied, returns (False, default_mail_from).
-
-        Some SMTP clients (issue #36) do not allow the From address to differ
-        from the authenticated user.  We drop any existing From headers and
-        insert the value stored in ``session.lookup_from_email`` if set.
-        Returns the mail_from value that should be supplied to Graph.
-        """
 
-        if not getattr(session, 'lookup_from_email', None):
-            logging.debug("No from-override configured; using envelope.mail_from")
-            return False, default_mail_from
+def saturation() -> float:
+    """
+    Return the share of capacity in use: the higher of the Graph send capacity
+    in use (messages sending or waiting for a slot, relative to
+    GRAPH_MAX_CONCURRENCY) and the event loop's lag relative to
+    _LOOP_LAG_SATURATED. Above 1, messages are queueing.
+    """
+    graph = (scheduler.active + scheduler.queued) / max(1, GRAPH_MAX_CONCURRENCY)
+    return max(graph, metrics.event_loop_lag / _LOOP_LAG_SATURATED)
 
-        new_from = session.lookup_from_email
-        logging.info(f"Overriding From header to '{new_from}' per lookup_from_email setting")
 
-        # remove all existing From headers
-        while 'From' in raw_envelope:
-            del raw_envelope['From']
+async def report_saturation():
+    """
+    Publish saturation() as a gauge that autoscalers can scale on. Runs until cancelled.
+    """
+    while True:
+        metrics.SATURATION.set(saturation())
+        await asyncio.sleep(_SATURATION_INTERVAL)
 
-        raw_envelope['From'] = new_from
-        return True, new_from
 
+def status(handler: Handler, spool: Spool | None, listeners: list[tuple[CustomController, str]]) -> dict:
+    """
+    Return the readiness report served on /readyz.
+    """
+    return {
+        "ready": handler.ready and not handler.draining,
+        "starting": not handler.ready,
+        "draining": handler.draining,
+        "listeners": [
+            {"port": controller.port, "mode": mode, "listening": controller.server is not None}
+            for controller, mode in listeners
+        ],
+        "saturation": round(saturation(), 3),
+        "event_loop_lag_seconds": round(metrics.event_loop_lag, 4),
+        "in_flight_data": handler.in_flight,
+        "graph_sending": scheduler.active,
+        "graph_queued": scheduler.queued,
+        "spool_pending": len(spool) if spool is not None else None,
+        "round_trip_seconds": {name: round(value, 4) for name, value in metrics.last_round_trip.items()}
+    }
 
 
-# noinspection PyShadowingNames
-async def amain():
+def spool_directories(worker: int | None) -> tuple[str, list[str]]:
+    """
+    Return the spool directory of a worker and the directories it should adopt.
+    With several workers every worker slot has its own subdirectory; the first
+    worker (or the only process) takes over messages left in directories that
+    no current worker owns, e.g. after WORKERS was changed.
+    """
+    own = SPOOL_DIR if worker is None else os.path.join(SPOOL_DIR, f"worker-{worker}")
+    if worker:
+        return own, []
+
+    adopt = [] if worker is None else [SPOOL_DIR]
+    if os.path.isdir(SPOOL_DIR):
+        for name in os.listdir(SPOOL_DIR):
+            slot = name.removeprefix('worker-')
+            if slot.isdigit() and (worker is None or int(slot) >= WORKERS):
+                adopt.append(os.path.join(SPOOL_DIR, name))
+    return own, adopt
+
+
+async def shutdown(controllers: list[CustomController], handler: Handler, spool: Spool | None):
+    """
+    Drain and stop the relay: new connections and transactions are answered with
+    421, transactions already past MAIL get up to SHUTDOWN_TIMEOUT seconds to finish,
+    then the listeners are closed and the event loop stopped for cleanup.
+    """
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    logging.info(f"Shutdown requested; draining {handler.in_flight} in-flight message(s)")
+
+    if not await handler.drain(SHUTDOWN_TIMEOUT):
+        logging.warning(f"{handler.in_flight} message(s) still in progress after {SHUTDOWN_TIMEOUT}s; closing anyway")
+    if spool is not None and not await spool.close(max(0.0, deadline - time.monotonic())):
+        logging.warning("Spool deliveries still in progress; they are retried after restart")
+
+    for controller in controllers:
+        if controller.server is not None:
+            controller.server.close()
+    asyncio.get_running_loop().stop()
+
+
+def load_tls() -> sslContext.ReloadableContext | None:
+    """
+    Load the TLS certificate configured by TLS_SOURCE. Blocking.
+    """
     match TLS_SOURCE:
         case 'file':
-            context = sslContext.from_file(TLS_CERT_FILEPATH, TLS_KEY_FILEPATH)
+            tls = sslContext.from_file(TLS_CERT_FILEPATH, TLS_KEY_FILEPATH)
             logging.info(f"Loaded certificate from file: {TLS_CERT_FILEPATH}")
             
         case 'keyvault':
             if not AZURE_KEY_VAULT_URL or not AZURE_KEY_VAULT_CERT_NAME:
                 logging.error("Azure Key Vault URL and Certificate Name must be set when TLS_SOURCE is 'keyvault'")
                 raise ValueError("Azure Key Vault URL and Certificate Name must be set")
-            context = sslContext.from_keyvault(AZURE_KEY_VAULT_URL, AZURE_KEY_VAULT_CERT_NAME)
+            tls = sslContext.from_keyvault(AZURE_KEY_VAULT_URL, AZURE_KEY_VAULT_CERT_NAME)
             logging.info(f"Loaded certificate from Azure Key Vault: {AZURE_KEY_VAULT_CERT_NAME}")
             
         case 'off':
-            context = None
+            tls = None
 
         case _:
             logging.error(f"Invalid TLS_SOURCE: {TLS_SOURCE}")
             raise ValueError(f"Invalid TLS_SOURCE: {TLS_SOURCE}")
 
-    # Configure TLS cipher suite if specified
-    if context:
-        if TLS_CIPHER_SUITE:
-            context.set_ciphers(TLS_CIPHER_SUITE)
+    if tls:
+        logging.info(f"TLS cipher suites used: {', '.join([i['name'] for i in tls.context.get_ciphers()])}")
+    return tls
+
 
-        logging.info(f"TLS cipher suites used: {', '.join([i['name'] for i in context.get_ciphers()])}")
+async def prepare_tables():
+    """
+    Create the table client and run the table checks configured for startup.
+    """
+    # importing the Azure SDKs and creating the client takes a while; keep it off the event loop
+    await asyncio.to_thread(azure_table.get_client)
 
     # If AZURE_TABLES_FORCE_USAGE is enabled, verify table access at startup
     if AZURE_TABLES_FORCE_USAGE:
-        azure_table.verify_table_access()
+        await azure_table.verify_table_access()
         logging.info("Azure Table access verified (AZURE_TABLES_FORCE_USAGE=true)")
 
-    controller = None
+    # In snapshot mode, answer table lookups from memory
+    if AZURE_TABLES_SNAPSHOT:
+        await azure_table.load_snapshot()
+
+
+def create_controller(handler: Handler, authenticator: Authenticator, port: int, mode: str, worker: int | None) -> CustomController:
+    """
+    Create the SMTP server for one of the LISTENERS. All listeners share the
+    handler, and with it the caches, the HTTP client and the Graph scheduler.
+
+    - starttls: STARTTLS is offered and required before AUTH
+    - optional: STARTTLS is offered, AUTH is also allowed without it
+    - implicit: TLS from the first byte (SMTPS); the certificate is set before it listens
+    """
+    return CustomController(
+        handler,
+        hostname='', # bind dual-stack on all interfaces
+        port=port,
+        ident=SERVER_GREETING,
+        authenticator=authenticator,
+        auth_required=True,
+        auth_require_tls=mode != 'optional',
+        require_starttls=mode == 'starttls',
+        implicit_tls=mode == 'implicit',
+        tls_context=None, # set once the certificate is loaded
+        data_size_limit=MAX_MESSAGE_SIZE or None,
+        loop=asyncio.get_running_loop(),
+        reuse_port=worker is not None
+    )
+
+
+def describe(listeners: list[tuple[CustomController, str]]) -> str:
+    return ', '.join(f"{controller.port} ({mode})" for controller, mode in listeners)
+
+
+# noinspection PyShadowingNames
+async def amain(worker: int | None = None, ready=None):
+    if AZURE_TABLES_SNAPSHOT and not AZURE_TABLES_URL:
+        logging.error("AZURE_TABLES_URL must be set when AZURE_TABLES_SNAPSHOT is enabled")
+        raise ValueError("AZURE_TABLES_URL must be set when AZURE_TABLES_SNAPSHOT is enabled")
+    if TLS_SOURCE == 'off' and any(mode == 'implicit' for _, mode in LISTENERS):
+        logging.error("Implicit TLS listeners need a certificate; TLS_SOURCE must not be 'off'")
+        raise ValueError("Implicit TLS listeners need a certificate; TLS_SOURCE must not be 'off'")
+
+    handler = Handler()
+    authenticator = Authenticator()
+    listeners = [
+        (create_controller(handler, authenticator, port, mode, worker), mode)
+        for port, mode in LISTENERS
+    ]
+    controllers = [controller for controller, _ in listeners]
+    try:
+        # A single process listens right away and answers 421 until it is ready,
+        # so clients and TCP probes see it early. Workers share the ports with the
+        # others, so they only listen once ready and connections keep going to
+        # workers that can take them. Implicit TLS listeners wait for the certificate.
+        if worker is None:
+            early = [(controller, mode) for controller, mode in listeners if mode != 'implicit']
+            for controller, _ in early:
+                await controller.start()
+            if early:
+                logging.info(f"SMTP OAuth relay server listening on port(s) {describe(early)}, starting up")
+    except Exception as e:
+        logging.exception(f"Failed to start SMTP server: {str(e)}")
+        raise
+
+    spool = Spool(*spool_directories(worker)) if SPOOL_DIR else None
+
+    # with several workers, the supervisor serves the aggregated metrics and the probes
+    if MONITORING_PORT and worker is None:
+        await monitoring.start(MONITORING_PORT, status=lambda: status(handler, spool, listeners))
+
+    # Independent startup steps run concurrently. The spool is opened before
+    # accepting mail so leftover messages are replayed first. Creating the
+    # shared HTTP client up front spares the first AUTH its TLS setup.
+    startup = [asyncio.to_thread(http_client.get_client)]
+    if AZURE_TABLES_URL:
+        startup.append(prepare_tables())
+    if spool is not None:
+        startup.append(spool.open())
+    tls, *_ = await asyncio.gather(asyncio.to_thread(load_tls), *startup)
+
+    for controller, mode in listeners:
+        if mode == 'implicit':
+            controller.ssl_context = tls.context
+        else:
+            controller.SMTP_kwargs['tls_context'] = tls.context if tls else None
+    handler.spool = spool
     try:
-        controller = CustomController(
-            Handler(),
-            hostname='', # bind dual-stack on all interfaces
-            port=8025,
-            ident=SERVER_GREETING,
-            authenticator=Authenticator(),
-            auth_required=True,
-            auth_require_tls=REQUIRE_TLS,
-            require_starttls=REQUIRE_TLS,
-            tls_context=context
-        )
-        controller.start()
-        logging.info(f"SMTP OAuth relay server started on port 8025")
+        for controller in controllers:
+            if controller.server is None:
+                await controller.start()
+        handler.ready = True
+        logging.info(f"SMTP OAuth relay server started on port(s) {describe(listeners)}")
+        if ready is not None:
+            ready.set()
+
+        # from now on SIGTERM drains in-flight messages instead of stopping right away
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, lambda: start_background_task(shutdown(controllers, handler, spool)))
     except Exception as e:
         logging.exception(f"Failed to start SMTP server: {str(e)}")
-        if controller:
-            controller.stop()
         raise
 
+    if TOKEN_CACHE_SIZE > 0 and TOKEN_REFRESH_WINDOW > 0:
+        start_background_task(refresh_tokens())
+    if AZURE_TABLES_SNAPSHOT:
+        start_background_task(azure_table.sync_snapshot())
+    if spool is not None:
+        start_background_task(spool.run())
+    if tls and TLS_RELOAD_INTERVAL > 0:
+        start_background_task(tls.watch(TLS_RELOAD_INTERVAL))
+    start_background_task(metrics.monitor_event_loop())
+    start_background_task(report_saturation())
 
-if __name__ == '__main__':
-    # Setup logging
+
+def setup_logging():
     logging.basicConfig(
         level=LOG_LEVEL,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        format='%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(message)s' if WORKERS > 1
+            else '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
 
+
+def run(worker: int | None = None, ready=None):
     # Create event loop
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    
-    # Run main function
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    # Run main function; if startup fails, stop instead of idling without a listener
+    main_task = loop.create_task(amain(worker, ready))
+    main_task.add_done_callback(lambda task: task.cancelled() or task.exception() is None or loop.stop())
     try:
-        loop.create_task(amain())
         loop.run_forever()
     except KeyboardInterrupt:
         logging.info("Shutdown requested via keyboard interrupt")
@@ -377,7 +558,36 @@ if __name__ == '__main__':
         logging.exception(f"Unexpected error: {str(e)}")
     finally:
         logging.info("Shutting down...")
+        loop.run_until_complete(monitoring.close())
+        mime.close_pool()
+        loop.run_until_complete(http_client.close())
+        loop.run_until_complete(azure_table.close())
         tasks = asyncio.all_tasks(loop)
         for task in tasks:
             task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
         loop.close()
+
+    if main_task.done() and not main_task.cancelled() and main_task.exception() is not None:
+        logging.error(f"Startup failed: {str(main_task.exception())}")
+        sys.exit(1)
+
+
+def run_worker(worker: int, ready):
+    """
+    Entry point of a worker process started by the supervisor.
+    """
+    # the supervisor decides when workers stop; ignore Ctrl+C sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    run(worker, ready)
+
+
+if __name__ == '__main__':
+    # Setup logging
+    setup_logging()
+
+    if WORKERS > 1:
+        supervisor.supervise(run_worker, WORKERS)
+    else:
+        run()
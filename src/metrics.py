@@ -0,0 +1,165 @@
+import asyncio
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+import cache
+
+
+# Latency buckets from 1 ms up to 2 minutes (HTTP_TIMEOUT)
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Message size buckets from 1 KiB up to 150 MiB (the Graph upload limit)
+_SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9)) + (150 * 1024 * 1024,)
+
+# How often the event loop lag is sampled
+_LOOP_LAG_INTERVAL = 0.5
+
+
+AUTH_DURATION = Histogram(
+    'smtp_relay_auth_duration_seconds',
+    'Time spent handling AUTH, by stage (total, table_lookup, token_fetch)',
+    ['stage'],
+    buckets=_LATENCY_BUCKETS
+)
+AUTH_RESULTS = Counter(
+    'smtp_relay_auth_total',
+    'AUTH attempts by result',
+    ['result']
+)
+REJECTED = Counter(
+    'smtp_relay_rejected',
+    'Connections and AUTH attempts turned away by rate limits, by reason',
+    ['reason']
+)
+DATA_DURATION = Histogram(
+    'smtp_relay_data_duration_seconds',
+    'Time spent handling DATA, by stage (total, mime, graph, spool)',
+    ['stage'],
+    buckets=_LATENCY_BUCKETS
+)
+MESSAGE_SIZE = Histogram(
+    'smtp_relay_message_size_bytes',
+    'Size of messages received in DATA',
+    buckets=_SIZE_BUCKETS
+)
+TOKEN_REQUEST_DURATION = Histogram(
+    'smtp_relay_token_request_duration_seconds',
+    'Duration of token requests to Entra ID (token cache misses and refreshes)',
+    buckets=_LATENCY_BUCKETS
+)
+GRAPH_REQUEST_DURATION = Histogram(
+    'smtp_relay_graph_request_duration_seconds',
+    'Duration of a message send to Microsoft Graph, excluding throttling waits',
+    buckets=_LATENCY_BUCKETS
+)
+GRAPH_QUEUE_DURATION = Histogram(
+    'smtp_relay_graph_queue_duration_seconds',
+    'Time a message waited for the throttling scheduler before being sent',
+    buckets=_LATENCY_BUCKETS
+)
+GRAPH_BATCH_SIZE = Histogram(
+    'smtp_relay_graph_batch_size',
+    'Messages per Graph request when batching is enabled',
+    buckets=(1, 2, 5, 10, 15, 20)
+)
+TABLE_QUERY_DURATION = Histogram(
+    'smtp_relay_table_query_duration_seconds',
+    'Duration of single-entity Azure Table queries (lookup cache misses)',
+    buckets=_LATENCY_BUCKETS
+)
+GRAPH_RESPONSES = Counter(
+    'smtp_relay_graph_responses_total',
+    'Graph send responses by HTTP status code ("error" if there was no response)',
+    ['status']
+)
+# Gauges say how to combine values across worker processes (WORKERS > 1)
+ACTIVE_SESSIONS = Gauge(
+    'smtp_relay_active_sessions',
+    'Number of open SMTP connections',
+    multiprocess_mode='livesum'
+)
+EVENT_LOOP_LAG = Gauge(
+    'smtp_relay_event_loop_lag_seconds',
+    'Delay of the last event loop lag probe beyond its scheduled wake-up time',
+    multiprocess_mode='livemax'
+)
+SATURATION = Gauge(
+    'smtp_relay_saturation',
+    'Share of the relay\'s capacity in use; above 1 messages are queueing (for autoscaling)',
+    multiprocess_mode='livemax'
+)
+CACHE_HITS = Counter(
+    'smtp_relay_cache_hits',
+    'Cache lookups served from memory',
+    ['cache']
+)
+CACHE_MISSES = Counter(
+    'smtp_relay_cache_misses',
+    'Cache lookups that had to fetch',
+    ['cache']
+)
+CACHE_COALESCED = Counter(
+    'smtp_relay_cache_coalesced',
+    'Cache misses that joined a fetch already in flight',
+    ['cache']
+)
+CACHE_ENTRIES = Gauge(
+    'smtp_relay_cache_entries',
+    'Number of entries in the cache',
+    ['cache'],
+    multiprocess_mode='livesum'
+)
+
+# Duration of the most recent request to each dependency (graph, entra, tables)
+last_round_trip: dict[str, float] = {}
+
+# Lag measured by the most recent event loop probe
+event_loop_lag = 0.0
+
+# Cache counters as of the last export, by cache name
+_exported_cache_stats: dict[str, tuple[int, int, int]] = {}
+
+
+def _export_cache_stats():
+    # the caches keep plain integers on the hot path; publish what changed since last time
+    for instance in cache.instances:
+        hits, misses, coalesced = _exported_cache_stats.get(instance.name, (0, 0, 0))
+        CACHE_HITS.labels(instance.name).inc(instance.hits - hits)
+        CACHE_MISSES.labels(instance.name).inc(instance.misses - misses)
+        CACHE_COALESCED.labels(instance.name).inc(instance.coalesced - coalesced)
+        CACHE_ENTRIES.labels(instance.name).set(len(instance))
+        _exported_cache_stats[instance.name] = (instance.hits, instance.misses, instance.coalesced)
+
+
+@contextmanager
+def round_trip(dependency: str, histogram: Histogram):
+    """
+    Time a request to a dependency into histogram and keep it as the latest round-trip.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        last_round_trip[dependency] = elapsed = time.perf_counter() - start
+        histogram.observe(elapsed)
+
+
+def record_graph_response(status_code: int | None):
+    GRAPH_RESPONSES.labels(str(status_code) if status_code else 'error').inc()
+
+
+async def monitor_event_loop():
+    """
+    Measure how late the event loop wakes up a sleeping task. A lag well above a
+    few milliseconds means CPU-bound work is holding up every SMTP session.
+    Also publishes the cache statistics. Runs until cancelled.
+    """
+    global event_loop_lag
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(_LOOP_LAG_INTERVAL)
+        event_loop_lag = max(0.0, time.monotonic() - start - _LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.set(event_loop_lag)
+        _export_cache_stats()
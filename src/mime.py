@@ -0,0 +1,459 @@
+import asyncio
+import base64
+import binascii
+import functools
+import logging
+import mmap
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email import message_from_string, policy
+from email.message import Message
+from email.parser import BytesHeaderParser
+from quopri import decodestring
+from typing import Iterator
+
+from env import LOG_LEVEL, MIME_POOL_SIZE, MIME_POOL_THRESHOLD
+
+
+# A quoted-printable transfer encoding header of any MIME part. A match inside a
+# body only costs an unnecessary parse, never a missed conversion.
+_QP_PATTERN = re.compile(rb'content-transfer-encoding:[ \t]*"?quoted-printable', re.IGNORECASE)
+
+# Literal part of _QP_PATTERN that the regex engine can scan for quickly
+_QP_HINT_PATTERN = re.compile(rb'-printable', re.IGNORECASE)
+
+# The blank line separating the top-level headers from the body
+_HEADER_END_PATTERN = re.compile(rb'\r?\n\r?\n')
+
+_FROM_HEADER_PATTERN = re.compile(rb'from:', re.IGNORECASE)
+
+_CONTENT_HEADER_PATTERN = re.compile(rb'content-', re.IGNORECASE)
+
+# Encoded bytes decoded at a time by decoded_chunks
+_DECODE_BLOCK_SIZE = 1024 * 1024
+
+_BASE64_IGNORED = re.compile(rb'[^A-Za-z0-9+/=]')
+
+# Header lines longer than this are folded when spliced in
+_MAX_HEADER_LINE_LENGTH = 78
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def parse_message(content: bytes | mmap.mmap, message_policy=policy.compat32) -> Message:
+    """
+    Parse a complete message like email.message_from_bytes, which decodes the
+    same way but only accepts bytes; this also takes the memory-mapped content
+    of large messages without copying it first.
+    """
+    return message_from_string(str(content, 'ascii', 'surrogateescape'), policy=message_policy)
+
+
+def _header_end(content: bytes, start: int = 0, end: int | None = None) -> int:
+    """
+    Return the offset at which the header block starting at start ends, i.e.
+    content[start:offset] holds the header lines (each with its line ending) and
+    content[offset:end] starts with the blank separator line, if any.
+    """
+    end = len(content) if end is None else end
+    if content[start:start + 1] == b'\n' or content[start:start + 2] == b'\r\n':
+        return start
+
+    match = _HEADER_END_PATTERN.search(content, start, end)
+    if match is None:
+        return end
+    return match.start() + (2 if content[match.start():match.start() + 2] == b'\r\n' else 1)
+
+
+def _skip_line_break(content: bytes, offset: int, end: int) -> int:
+    if content[offset:offset + 2] == b'\r\n':
+        return min(end, offset + 2)
+    if content[offset:offset + 1] == b'\n':
+        return min(end, offset + 1)
+    return offset
+
+
+def _has_quoted_printable(content: bytes) -> bool:
+    # anchoring _QP_PATTERN at every line start is slow on large bodies, so only
+    # check the lines that contain the hint
+    for hint in _QP_HINT_PATTERN.finditer(content):
+        line_start = content.rfind(b'\n', 0, hint.start()) + 1
+        if _QP_PATTERN.match(content, line_start):
+            return True
+    return False
+
+
+def _missing_bcc(headers: Message, rcpt_tos: list[str]) -> str | None:
+    """Return the Bcc header value needed to cover recipients missing from To/Cc,
+    or None if no fix is needed.
+
+    Issue #82: some clients do not include Bcc recipients in the headers
+    at all, which causes Graph to drop them. The workaround is to compute
+    which rcpt_tos are not already in To/Cc and add them as a Bcc header.
+    """
+
+    to_headers = headers.get_all('To', [])
+    cc_headers = headers.get_all('Cc', [])
+    total_headers = len(to_headers) + len(cc_headers)
+    logging.debug(f"Headers count - To: {len(to_headers)}, Cc: {len(cc_headers)}")
+
+    if len(rcpt_tos) <= total_headers:
+        logging.debug("No missing recipients detected; skipping Bcc fixup")
+        return None
+
+    header_recipients = set(to_headers + cc_headers)
+    missing = set(rcpt_tos) - header_recipients
+    if not missing:
+        logging.debug("Mismatch between rcpt_tos and headers, but no missing recipients")
+        return None
+
+    logging.info(f"Adding Bcc header for missing recipients: {sorted(missing)}")
+    # preserve any existing Bcc header by appending if present
+    existing_bcc = headers.get_all('Bcc', [])
+    combined = list(existing_bcc) + sorted(missing)
+    return ", ".join(combined)
+
+
+def _header_line(name: str, value: str, linesep: bytes) -> bytes:
+    line = f"{name}: {value}"
+    if len(line) > _MAX_HEADER_LINE_LENGTH:
+        # fold between addresses; unfolding restores the original ", " separator
+        line = line.replace(", ", "," + linesep.decode('ascii') + " ")
+    return line.encode('utf-8', errors='surrogateescape') + linesep
+
+
+def _header_lines(header_block: bytes, linesep: bytes) -> list[bytes]:
+    """
+    Split a header block into lines, each ending with its line break.
+    """
+    lines = [line + b'\n' for line in header_block.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+    if lines[-1]:
+        # header block without a trailing line break (message has no body)
+        lines[-1] += linesep
+    else:
+        lines.pop()
+    return lines
+
+
+def _drop_headers(lines: list[bytes], pattern: re.Pattern) -> list[bytes]:
+    """
+    Remove the header lines whose name matches pattern, including their continuation lines.
+    """
+    kept = []
+    dropping = False
+    for line in lines:
+        if line[:1] not in (b' ', b'\t'):
+            dropping = pattern.match(line) is not None
+        if not dropping:
+            kept.append(line)
+    return kept
+
+
+def _splice_headers(content: bytes, header_end: int, bcc: str | None, from_override: str | None) -> bytes:
+    """
+    Rewrite only the top-level header block and join it with the untouched
+    original body, so header fixes cost the same regardless of attachment size.
+    """
+    header_block = content[:header_end]
+    linesep = b'\n' if b'\n' in header_block and b'\r\n' not in header_block else b'\r\n'
+
+    lines = _header_lines(header_block, linesep)
+
+    if from_override:
+        # remove all existing From headers
+        lines = _drop_headers(lines, _FROM_HEADER_PATTERN)
+
+    if bcc is not None:
+        lines.append(_header_line('Bcc', bcc, linesep))
+    if from_override:
+        lines.append(_header_line('From', from_override, linesep))
+
+    # the body is only referenced through a memoryview until the final join
+    return b''.join((*lines, memoryview(content)[header_end:]))
+
+
+def _convert_quoted_printable(msg: Message, location: str = 'root') -> bool:
+    """
+    Convert quoted-printable MIME parts to base64 in place, since Graph API
+    mangles some quoted-printable content. Returns True if any part was converted.
+    """
+    modified = False
+    if msg.is_multipart():
+        for index, part in enumerate(msg.get_payload()):
+            if _convert_quoted_printable(part, f"{location}.{index}"):
+                modified = True
+    else:
+        if msg.get('Content-Transfer-Encoding', '').lower().strip() == 'quoted-printable':
+            logging.debug(
+                f"Converting quoted-printable MIME part at {location} "
+                f"(content-type={msg.get_content_type()})"
+            )
+            qp_payload = msg.get_payload(decode=False)
+            if isinstance(qp_payload, str):
+                decoded = decodestring(qp_payload.encode('ascii', errors='surrogateescape'))
+            else:
+                decoded = decodestring(qp_payload)
+            msg.set_payload(base64.encodebytes(decoded).decode('ascii'))
+            del msg['Content-Transfer-Encoding']
+            msg['Content-Transfer-Encoding'] = 'base64'
+            modified = True
+    return modified
+
+
+def _prescan(content: bytes, rcpt_tos: list[str], from_override: str | None, sanitize_encoding: bool) -> tuple[int, str | None, bool]:
+    """
+    Decide from the top-level headers and a scan for quoted-printable parts what
+    needs rewriting. Returns (header_end, bcc, needs_conversion).
+    """
+    header_end = _header_end(content)
+    headers = BytesHeaderParser(policy=policy.compat32).parsebytes(content[:header_end])
+
+    bcc = _missing_bcc(headers, rcpt_tos)
+    needs_conversion = sanitize_encoding and _has_quoted_printable(content)
+
+    if from_override:
+        logging.info(f"Overriding From header to '{from_override}' per lookup_from_email setting")
+    return header_end, bcc, needs_conversion
+
+
+def _convert_message(content: bytes, header_end: int, bcc: str | None, from_override: str | None) -> bytes:
+    """
+    Parse the full message once, apply the header fixes, convert quoted-printable
+    parts and serialize it once.
+    """
+    # any failure while parsing, converting or serializing falls back to the
+    # original body, with the header fixes still applied
+    try:
+        msg = parse_message(content)
+        if bcc is not None:
+            msg['Bcc'] = bcc
+        if from_override:
+            # remove all existing From headers
+            del msg['From']
+            msg['From'] = from_override
+
+        if _convert_quoted_printable(msg):
+            logging.info("Sanitized MIME encoding")
+        else:
+            logging.debug("No quoted-printable MIME parts found")
+        return msg.as_bytes()
+    except Exception:
+        logging.exception("Failed to sanitize MIME encoding; sending message with original encoding")
+        return _splice_headers(content, header_end, bcc, from_override)
+
+
+def prepare_message(content: bytes, rcpt_tos: list[str], from_override: str | None = None, sanitize_encoding: bool = True) -> bytes:
+    """
+    Apply the Bcc fixup, the From override and the quoted-printable to base64
+    conversion to a raw message before it is handed to Graph.
+
+    A header-only pre-scan decides what needs rewriting. If only headers change,
+    the rewritten header block is spliced onto the original body bytes. Only an
+    encoding conversion parses the full message, once, and serializes it once.
+    If nothing needs to change the original bytes are returned as they are.
+
+    From override (issue #36): some SMTP clients do not allow the From address
+    to differ from the authenticated user, so any existing From headers are
+    replaced by from_override when it is set.
+    """
+    header_end, bcc, needs_conversion = _prescan(content, rcpt_tos, from_override, sanitize_encoding)
+
+    if bcc is None and not from_override and not needs_conversion:
+        logging.debug("No header fixes or encoding changes needed; message unchanged")
+        return content
+
+    if not needs_conversion:
+        logging.debug("Splicing fixed headers onto the original message body")
+        return _splice_headers(content, header_end, bcc, from_override)
+
+    return _convert_message(content, header_end, bcc, from_override)
+
+
+class MimePart:
+    """
+    A leaf MIME part located in a raw message: its parsed headers and the
+    offsets of its header block, encoded body and end. message/rfc822 parts
+    are leaves; their content is the nested message.
+    """
+
+    __slots__ = ('headers', 'start', 'body_start', 'end', 'in_alternative')
+
+    def __init__(self, headers: Message, start: int, body_start: int, end: int, in_alternative: bool):
+        self.headers = headers
+        self.start = start
+        self.body_start = body_start
+        self.end = end
+        # direct child of a multipart/alternative
+        self.in_alternative = in_alternative
+
+
+def _boundary_pattern(boundary: str) -> re.Pattern:
+    # a delimiter line; the line break before it belongs to the delimiter
+    return re.compile(rb'\r?\n--' + re.escape(boundary.encode('ascii', 'surrogateescape')) + rb'(--)?[ \t]*(?:\r?\n|\Z)')
+
+
+def _walk(content: bytes, start: int, end: int, in_alternative: bool) -> Iterator[MimePart]:
+    header_end = _header_end(content, start, end)
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(content[start:header_end])
+    body_start = _skip_line_break(content, header_end, end)
+
+    boundary = headers.get_boundary() if headers.get_content_maintype() == 'multipart' else None
+    if not boundary:
+        yield MimePart(headers, start, body_start, end, in_alternative)
+        return
+
+    alternative = headers.get_content_subtype() == 'alternative'
+    pattern = _boundary_pattern(boundary)
+    # start one byte early, so a delimiter right after the headers is found
+    delimiter = pattern.search(content, max(start, body_start - 1), end)
+    while delimiter is not None and not delimiter.group(1):
+        part_start = delimiter.end()
+        delimiter = pattern.search(content, part_start - 1, end)
+        part_end = delimiter.start() if delimiter is not None else end
+        if part_end > part_start:
+            yield from _walk(content, part_start, part_end, alternative)
+
+
+def walk_parts(content: bytes) -> Iterator[MimePart]:
+    """
+    Yield the leaf parts of a message in order by scanning for boundaries in
+    the raw bytes, without building the MIME tree or copying bodies.
+    Works on bytes and on memory-mapped content.
+    """
+    return _walk(content, 0, len(content), False)
+
+
+def decoded_chunks(content: bytes, part: MimePart) -> Iterator[bytes]:
+    """
+    Decode the body of a part according to its Content-Transfer-Encoding, a
+    block of about _DECODE_BLOCK_SIZE encoded bytes at a time.
+    """
+    encoding = str(part.headers.get('Content-Transfer-Encoding', '')).strip().lower()
+    pending = b''
+    position = part.body_start
+    while position < part.end:
+        stop = min(part.end, position + _DECODE_BLOCK_SIZE)
+        if stop < part.end:
+            # end blocks at a line break, so no encoded sequence is split
+            line_end = content.rfind(b'\n', position, stop)
+            if line_end >= position:
+                stop = line_end + 1
+        block = content[position:stop]
+        position = stop
+
+        if encoding == 'base64':
+            block = pending + _BASE64_IGNORED.sub(b'', block)
+            usable = len(block) - len(block) % 4
+            pending = block[usable:]
+            if usable:
+                yield binascii.a2b_base64(block[:usable])
+        elif encoding == 'quoted-printable':
+            yield decodestring(block)
+        else:
+            yield block
+
+    if pending:
+        # truncated base64; decode what is there like the email package does
+        yield binascii.a2b_base64(pending + b'=' * (-len(pending) % 4))
+
+
+def decoded_size(content: bytes, part: MimePart) -> int:
+    """
+    Return the size of the decoded body of a part, decoding it block by block.
+    """
+    return sum(len(chunk) for chunk in decoded_chunks(content, part))
+
+
+def part_text(content: bytes, part: MimePart) -> str:
+    """
+    Return the decoded text of a text part.
+    """
+    charset = part.headers.get_content_charset('us-ascii')
+    data = b''.join(decoded_chunks(content, part))
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def mime_skeleton(content: bytes, body: MimePart | None) -> bytes:
+    """
+    Return a message with the top-level headers of content and only the body
+    part, for creating a draft that keeps every header but none of the attachments.
+    """
+    header_end = _header_end(content)
+    if body is not None and body.start == 0:
+        # a single-part message is its own body
+        return bytes(content[:body.end])
+
+    header_block = content[:header_end]
+    linesep = b'\n' if b'\n' in header_block and b'\r\n' not in header_block else b'\r\n'
+    lines = _drop_headers(_header_lines(header_block, linesep), _CONTENT_HEADER_PATTERN)
+    if body is None:
+        return b''.join((*lines, b'Content-Type: text/plain; charset=utf-8', linesep, linesep))
+    return b''.join((*lines, content[body.start:body.end]))
+
+
+def _init_pool_process():
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(message)s'
+    )
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=MIME_POOL_SIZE,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_pool_process
+        )
+    return _pool
+
+
+def close_pool():
+    """
+    Shut down the MIME process pool, if it was started.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def prepare_message_async(content: bytes, rcpt_tos: list[str], from_override: str | None = None, sanitize_encoding: bool = True) -> bytes:
+    """
+    Run prepare_message without holding up the event loop for large messages.
+
+    The pre-scan and header splicing run inline, since they cost little even for
+    large messages. Only the full parse and quoted-printable conversion of
+    messages of at least MIME_POOL_THRESHOLD bytes runs in a pool of
+    MIME_POOL_SIZE processes; for smaller ones copying the message to another
+    process costs more than it saves.
+    """
+    if MIME_POOL_SIZE <= 0 or len(content) < MIME_POOL_THRESHOLD:
+        return prepare_message(content, rcpt_tos, from_override, sanitize_encoding)
+
+    header_end, bcc, needs_conversion = _prescan(content, rcpt_tos, from_override, sanitize_encoding)
+    if not needs_conversion:
+        if bcc is None and not from_override:
+            logging.debug("No header fixes or encoding changes needed; message unchanged")
+            return content
+        logging.debug("Splicing fixed headers onto the original message body")
+        return _splice_headers(content, header_end, bcc, from_override)
+
+    if not isinstance(content, bytes):
+        # a memory-mapped message cannot be pickled for the pool process
+        content = bytes(content)
+    call = functools.partial(_convert_message, content, header_end, bcc, from_override)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), call)
+    except BrokenProcessPool:
+        # a pool process died (e.g. killed for memory); start a new pool next time
+        logging.error("MIME process pool is broken; preparing message inline")
+        close_pool()
+        return call()
@@ -0,0 +1,66 @@
+import logging
+from typing import TYPE_CHECKING, Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+
+# aiohttp is only loaded when the endpoint is enabled
+if TYPE_CHECKING:
+    from aiohttp import web
+
+
+_runner: 'web.AppRunner | None' = None
+_registry: CollectorRegistry = REGISTRY
+_status: Callable[[], dict] | None = None
+
+
+async def handle_metrics(request: 'web.Request') -> 'web.Response':
+    from aiohttp import web
+    return web.Response(body=generate_latest(_registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def handle_healthz(request: 'web.Request') -> 'web.Response':
+    # answering at all shows the event loop is running
+    from aiohttp import web
+    return web.json_response({"status": "ok"})
+
+
+async def handle_readyz(request: 'web.Request') -> 'web.Response':
+    from aiohttp import web
+    status = _status() if _status is not None else {"ready": True}
+    return web.json_response(status, status=200 if status.get("ready") else 503)
+
+
+async def start(port: int, registry: CollectorRegistry = REGISTRY, status: Callable[[], dict] | None = None):
+    """
+    Serve the monitoring endpoints on the running event loop:
+    /metrics for Prometheus, /healthz for liveness and /readyz for readiness probes.
+
+    registry is what /metrics exports; the supervisor passes one that
+    aggregates all worker processes. status returns the readiness report;
+    /readyz answers 503 unless its "ready" entry is true.
+    """
+    from aiohttp import web
+
+    global _runner, _registry, _status
+    _registry = registry
+    _status = status
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    site = web.TCPSite(_runner, port=port) # bind dual-stack on all interfaces
+    await site.start()
+    logging.info(f"Monitoring endpoint started on port {port}")
+
+
+async def close():
+    """
+    Stop the monitoring endpoint if it was started.
+    """
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
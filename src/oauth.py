@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+import httpx
+import http_client
+import metrics
+from collections import OrderedDict
+
+from cache import TTLCache
+from env import (
+    TOKEN_CACHE_SIZE,
+    TOKEN_CACHE_EXPIRY_MARGIN,
+    TOKEN_REFRESH_WINDOW,
+    TOKEN_REFRESH_MIN_USES,
+    TOKEN_REFRESH_IDLE_TIMEOUT,
+    TOKEN_REFRESH_MAX_CREDENTIALS,
+    SESSION_TOKEN_RENEW_WINDOW,
+    AZURE_AUTHORITY_HOST,
+    GRAPH_ENDPOINT
+)
+
+
+# Per-process key for hashing client secrets; secrets are never used as cache keys in the clear
+_SECRET_HASH_KEY = os.urandom(32)
+
+# How often the background refresher looks for tokens about to expire
+_REFRESH_CHECK_INTERVAL = 30
+
+token_cache = TTLCache('token', TOKEN_CACHE_SIZE)
+
+
+class _HotCredential:
+    """Usage bookkeeping for a credential that may be kept warm by the refresher."""
+
+    __slots__ = ('tenant_id', 'client_id', 'client_secret', 'uses', 'last_used')
+
+    def __init__(self, tenant_id: str, client_id: str, client_secret: str):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.uses = 0
+        self.last_used = 0.0
+
+
+# Recently used credentials keyed like the token cache, least recently used first
+_hot_credentials: OrderedDict[tuple[str, str, str], _HotCredential] = OrderedDict()
+
+# Session token renewals in flight, keyed like the token cache, so that sessions
+# sharing credentials renew them with a single request
+_renewals: dict[tuple[str, str, str], asyncio.Task] = {}
+
+
+def secret_hash(client_secret: str) -> str:
+    """
+    Return a keyed SHA-256 hash of a client secret.
+    """
+    return hmac.new(_SECRET_HASH_KEY, client_secret.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def token_key(tenant_id: str, client_id: str, client_secret: str | bytes) -> tuple[str, str, str]:
+    """
+    Return the token cache key for a set of credentials.
+    """
+    if isinstance(client_secret, bytes):
+        client_secret = client_secret.decode("utf-8")
+    return tenant_id, client_id, secret_hash(client_secret)
+
+
+async def request_access_token(tenant_id: str, client_id: str, client_secret: str) -> tuple[str, int]:
+    """
+    Request a new access token from Entra ID using the client credentials flow.
+    Returns (access_token, expires_in).
+    """
+    data = {
+        "grant_type": "client_credentials",
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "scope": f"{GRAPH_ENDPOINT}/.default"
+    }
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+    try:
+        with metrics.round_trip('entra', metrics.TOKEN_REQUEST_DURATION):
+            response = await http_client.get_client().post(
+                url=f"{AZURE_AUTHORITY_HOST}/{tenant_id}/oauth2/v2.0/token",
+                data=data,
+                headers=headers
+            )
+        response.raise_for_status()
+        body = response.json()
+    except httpx.HTTPError as e:
+        logging.error(f"OAuth token request failed: {str(e)}")
+        if isinstance(e, httpx.HTTPStatusError):
+            logging.error(f"Response status: {e.response.status_code}, Response body: {e.response.text}")
+        raise
+
+    access_token = body.get("access_token")
+    if not access_token:
+        raise ValueError("OAuth token response did not contain an access_token")
+
+    return access_token, int(body.get("expires_in", 3599))
+
+
+def is_credential_error(error: Exception) -> bool:
+    """
+    Return True if a token request failed because Entra ID rejected the
+    credentials (unknown tenant or client, wrong secret), not for a transient reason.
+    """
+    return isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (400, 401)
+
+
+async def get_access_token(tenant_id: str, client_id: str, client_secret: str | bytes) -> str:
+    """
+    Return an access token for the given credentials, served from the token cache when possible.
+    Tokens are cached until TOKEN_CACHE_EXPIRY_MARGIN seconds before they expire.
+    """
+    if isinstance(client_secret, bytes):
+        client_secret = client_secret.decode("utf-8")
+
+    key = token_key(tenant_id, client_id, client_secret)
+    _record_use(key, tenant_id, client_id, client_secret)
+
+    async def fetch() -> tuple[str, float]:
+        access_token, expires_in = await request_access_token(tenant_id, client_id, client_secret)
+        return access_token, expires_in - TOKEN_CACHE_EXPIRY_MARGIN
+
+    access_token = await token_cache.get_or_fetch(key, fetch)
+    logging.debug(
+        f"Token cache stats: hits={token_cache.hits}, misses={token_cache.misses}, "
+        f"coalesced={token_cache.coalesced}, size={len(token_cache)}"
+    )
+    return access_token
+
+
+def _record_use(key: tuple[str, str, str], tenant_id: str, client_id: str, client_secret: str) -> None:
+    if TOKEN_REFRESH_WINDOW <= 0 or TOKEN_REFRESH_MAX_CREDENTIALS <= 0 or TOKEN_CACHE_SIZE <= 0:
+        return
+
+    credential = _hot_credentials.get(key)
+    if credential is None:
+        credential = _hot_credentials[key] = _HotCredential(tenant_id, client_id, client_secret)
+    _hot_credentials.move_to_end(key)
+    credential.uses += 1
+    credential.last_used = time.monotonic()
+
+    while len(_hot_credentials) > TOKEN_REFRESH_MAX_CREDENTIALS:
+        _hot_credentials.popitem(last=False)
+
+
+async def _refresh_token(key: tuple[str, str, str], credential: _HotCredential) -> None:
+    try:
+        access_token, expires_in = await request_access_token(
+            credential.tenant_id, credential.client_id, credential.client_secret
+        )
+    except Exception as e:
+        # most likely a revoked or rotated secret; stop keeping this credential warm
+        logging.warning(f"Background token refresh failed for client_id '{credential.client_id}': {str(e)}")
+        _hot_credentials.pop(key, None)
+        return
+
+    token_cache.set(key, access_token, expires_in - TOKEN_CACHE_EXPIRY_MARGIN)
+    logging.debug(f"Refreshed access token for client_id '{credential.client_id}' in the background")
+
+
+async def refresh_tokens():
+    """
+    Renew cached tokens of hot credentials shortly before they expire, so that
+    busy senders never wait for a token request during AUTH.
+
+    A credential is hot if it was used at least TOKEN_REFRESH_MIN_USES times since
+    its last refresh and within the last TOKEN_REFRESH_IDLE_TIMEOUT seconds. At most
+    TOKEN_REFRESH_MAX_CREDENTIALS credentials are tracked. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(_REFRESH_CHECK_INTERVAL)
+
+        now = time.monotonic()
+        due = []
+        for key, credential in list(_hot_credentials.items()):
+            if now - credential.last_used > TOKEN_REFRESH_IDLE_TIMEOUT:
+                del _hot_credentials[key]
+                continue
+
+            remaining = token_cache.ttl(key)
+            if remaining is None or remaining > TOKEN_REFRESH_WINDOW:
+                continue
+            if credential.uses < TOKEN_REFRESH_MIN_USES:
+                continue
+
+            credential.uses = 0
+            due.append(_refresh_token(key, credential))
+
+        if due:
+            logging.info(f"Refreshing {len(due)} access token(s) in the background")
+            await asyncio.gather(*due)
+
+
+async def _renew_token(key: tuple[str, str, str], tenant_id: str, client_id: str, client_secret: str) -> tuple[str, float]:
+    try:
+        access_token, expires_in = await request_access_token(tenant_id, client_id, client_secret)
+        lifetime = expires_in - TOKEN_CACHE_EXPIRY_MARGIN
+        token_cache.set(key, access_token, lifetime)
+        logging.debug(f"Renewed session access token for client_id '{client_id}'")
+        return access_token, time.monotonic() + lifetime
+    finally:
+        _renewals.pop(key, None)
+
+
+class SessionToken:
+    """
+    The access token of an authenticated SMTP session.
+
+    Clients that keep one connection open for many messages outlive the token
+    they got at AUTH. Once the token is within SESSION_TOKEN_RENEW_WINDOW seconds
+    of expiry, the next DATA starts renewing it in the background and keeps using
+    the current one; a DATA only waits for the renewal if the token has expired.
+    Tokens renewed by other sessions or the background refresher are picked up
+    from the token cache without a request.
+    """
+
+    __slots__ = ('tenant_id', 'client_id', 'client_secret', 'key', 'access_token', 'expires_at', '_renewal')
+
+    def __init__(self, tenant_id: str, client_id: str, client_secret: str | bytes):
+        if isinstance(client_secret, bytes):
+            client_secret = client_secret.decode("utf-8")
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.key = token_key(tenant_id, client_id, client_secret)
+        self.access_token: str | None = None
+        self.expires_at = 0.0
+        self._renewal: asyncio.Task | None = None
+
+    async def fetch(self) -> str:
+        """
+        Get the initial token during AUTH, from the token cache when possible.
+        """
+        if TOKEN_CACHE_SIZE <= 0:
+            # no cache to read the lifetime from; keep the one from the response
+            self.access_token, expires_in = await request_access_token(self.tenant_id, self.client_id, self.client_secret)
+            self.expires_at = time.monotonic() + expires_in - TOKEN_CACHE_EXPIRY_MARGIN
+            return self.access_token
+
+        self.access_token = await get_access_token(self.tenant_id, self.client_id, self.client_secret)
+        # without a cache entry the lifetime is unknown; renew on first use
+        remaining = token_cache.ttl(self.key)
+        self.expires_at = time.monotonic() + (remaining if remaining is not None else SESSION_TOKEN_RENEW_WINDOW)
+        return self.access_token
+
+    def lifetime(self) -> float:
+        """
+        Return roughly how many seconds the current token remains valid for Graph.
+        """
+        # expires_at is when the token leaves the cache, TOKEN_CACHE_EXPIRY_MARGIN before it expires
+        return self.expires_at + TOKEN_CACHE_EXPIRY_MARGIN - time.monotonic()
+
+    def expire(self):
+        """
+        Treat the current token as expired, e.g. after Graph rejected it, so the
+        next get() renews it.
+        """
+        self.expires_at = 0.0
+
+    async def get(self) -> str:
+        """
+        Return a token that has not expired, renewing it if needed.
+        Raises if the token has expired and cannot be renewed.
+        """
+        if self._renewal is not None and self._renewal.done():
+            self._finish_renewal()
+
+        now = time.monotonic()
+        if now < self.expires_at - SESSION_TOKEN_RENEW_WINDOW:
+            return self.access_token
+
+        cached = token_cache.get(self.key)
+        if cached is not None and cached != self.access_token:
+            self.access_token = cached
+            self.expires_at = now + (token_cache.ttl(self.key) or 0.0)
+            if now < self.expires_at - SESSION_TOKEN_RENEW_WINDOW:
+                return self.access_token
+
+        if self._renewal is None:
+            self._renewal = _renewals.get(self.key)
+            if self._renewal is None:
+                self._renewal = asyncio.ensure_future(
+                    _renew_token(self.key, self.tenant_id, self.client_id, self.client_secret)
+                )
+                # a renewal nobody waits for still has its exception retrieved
+                self._renewal.add_done_callback(lambda t: t.cancelled() or t.exception())
+                _renewals[self.key] = self._renewal
+
+        if now >= self.expires_at:
+            # wait() leaves the renewal running if this session is cancelled; others may share it
+            await asyncio.wait([self._renewal])
+            self._finish_renewal(raise_errors=True)
+        return self.access_token
+
+    def _finish_renewal(self, raise_errors: bool = False):
+        task, self._renewal = self._renewal, None
+        if task.cancelled() or task.exception() is not None:
+            # keep the current token while it lasts; the next get() tries again
+            if raise_errors:
+                raise task.exception() or asyncio.CancelledError()
+            logging.warning(f"Session token renewal failed for client_id '{self.client_id}': {str(task.exception())}")
+            return
+        self.access_token, self.expires_at = task.result()
@@ -0,0 +1,141 @@
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+from cache import TTLCache
+from oauth import secret_hash
+from env import (
+    MAX_SESSIONS,
+    MAX_SESSIONS_PER_IP,
+    AUTH_FAILURE_LIMIT,
+    AUTH_FAILURE_WINDOW,
+    AUTH_FAILED_CREDENTIALS_TTL
+)
+
+
+# Upper bound on the number of client IPs and usernames tracked by a failure limiter
+_MAX_TRACKED_KEYS = 10000
+
+# Upper bound on cached failed and succeeded credentials
+_FAILED_CREDENTIALS_CACHE_SIZE = 10000
+_SUCCEEDED_CREDENTIALS_CACHE_SIZE = 10000
+
+
+class SessionLimiter:
+    """
+    Counts open SMTP connections, in total and per client IP. A limit of 0 means unlimited.
+    """
+
+    def __init__(self, max_sessions: int, max_per_ip: int):
+        self.max_sessions = max_sessions
+        self.max_per_ip = max_per_ip
+        self.total = 0
+        self._per_ip: dict[str, int] = {}
+
+    def acquire(self, ip: str) -> str | None:
+        """
+        Admit a new connection from ip. Returns None if admitted, otherwise the
+        limit that was hit; a connection that was not admitted must not be released.
+        """
+        if self.max_sessions and self.total >= self.max_sessions:
+            return 'max_sessions'
+        count = self._per_ip.get(ip, 0)
+        if self.max_per_ip and count >= self.max_per_ip:
+            return 'max_sessions_per_ip'
+
+        self.total += 1
+        self._per_ip[ip] = count + 1
+        return None
+
+    def release(self, ip: str):
+        self.total -= 1
+        count = self._per_ip.get(ip, 0) - 1
+        if count > 0:
+            self._per_ip[ip] = count
+        else:
+            self._per_ip.pop(ip, None)
+
+
+class FailureLimiter:
+    """
+    Counts failures per key in fixed windows of window seconds; a key with
+    limit failures in its current window is blocked until the window ends.
+    A limit of 0 disables the limiter. The least recently failed keys are
+    forgotten first once maxsize keys are tracked.
+    """
+
+    def __init__(self, limit: int, window: float, maxsize: int = _MAX_TRACKED_KEYS):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        # key -> [failures, end of window]
+        self._failures: OrderedDict[Hashable, list] = OrderedDict()
+
+    def blocked(self, key: Hashable) -> bool:
+        entry = self._failures.get(key)
+        if entry is None:
+            return False
+        if entry[1] <= time.monotonic():
+            del self._failures[key]
+            return False
+        return entry[0] >= self.limit
+
+    def record(self, key: Hashable):
+        if self.limit <= 0:
+            return
+
+        now = time.monotonic()
+        entry = self._failures.get(key)
+        if entry is None or entry[1] <= now:
+            entry = self._failures[key] = [0, now + self.window]
+        entry[0] += 1
+        self._failures.move_to_end(key)
+
+        while len(self._failures) > self.maxsize:
+            self._failures.popitem(last=False)
+
+
+sessions = SessionLimiter(MAX_SESSIONS, MAX_SESSIONS_PER_IP)
+_failures_by_ip = FailureLimiter(AUTH_FAILURE_LIMIT, AUTH_FAILURE_WINDOW)
+_failures_by_username = FailureLimiter(AUTH_FAILURE_LIMIT, AUTH_FAILURE_WINDOW)
+
+# Credentials rejected by Entra ID (or unparseable usernames) keyed by credential_key()
+failed_credentials = TTLCache('failed_credentials', _FAILED_CREDENTIALS_CACHE_SIZE)
+
+# Credentials that logged in successfully within the last AUTH_FAILURE_WINDOW seconds, keyed by credential_key()
+succeeded_credentials = TTLCache('succeeded_credentials', _SUCCEEDED_CREDENTIALS_CACHE_SIZE)
+
+
+def credential_key(username: str, password: bytes) -> tuple[str, str]:
+    """
+    Return the failed-credential cache key for a login; the password is only kept as a keyed hash.
+    """
+    return username, secret_hash(password.decode('utf-8', errors='replace'))
+
+
+def auth_blocked(ip: str, username: str) -> bool:
+    """
+    Return True if AUTH from ip or for username failed too often recently.
+    Callers skip this check for credentials in succeeded_credentials, so
+    failures caused by others cannot lock out a sender with the right secret.
+    """
+    return _failures_by_ip.blocked(ip) or _failures_by_username.blocked(username)
+
+
+def record_auth_failure(ip: str, username: str, credential: tuple[str, str] | None = None):
+    """
+    Count a failed AUTH caused by bad credentials. If credential is given, the
+    same username and password are rejected locally for AUTH_FAILED_CREDENTIALS_TTL seconds.
+    """
+    _failures_by_ip.record(ip)
+    _failures_by_username.record(username)
+    if credential is not None:
+        failed_credentials.set(credential, True, AUTH_FAILED_CREDENTIALS_TTL)
+
+
+def record_auth_success(credential: tuple[str, str]):
+    """
+    Remember credentials that logged in, so they stay exempt from auth_blocked().
+    """
+    if _failures_by_ip.limit > 0:
+        succeeded_credentials.set(credential, True, AUTH_FAILURE_WINDOW)
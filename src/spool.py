@@ -0,0 +1,352 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+import oauth
+from throttle import scheduler
+from env import (
+    SPOOL_WORKERS,
+    SPOOL_RETRY_BASE,
+    SPOOL_RETRY_MAX,
+    SPOOL_MAX_AGE,
+    SPOOL_STORE_TOKEN
+)
+
+
+class Spool:
+    """
+    Durable store-and-forward queue for accepted messages.
+
+    Each message is kept as two files in the spool directory: <id>.eml holds the
+    prepared MIME message and <id>.json its delivery metadata. Both are fsynced
+    before the message is acknowledged, and the metadata file is written last,
+    so a message without metadata was never acknowledged and is discarded on
+    startup. Messages that cannot be delivered are moved to the failed/
+    subdirectory.
+
+    Neither the access token nor the client secret is written to disk, only the
+    token cache key of the credentials. While a message is pending, the spool
+    holds the session's token in memory and renews it before each attempt as
+    the session would. After a restart that is gone, so the message waits until
+    the same credentials log in again and put a token in the token cache, or
+    until SPOOL_MAX_AGE. With SPOOL_STORE_TOKEN the access token is also stored
+    with the message and used after a restart until it expires; it is removed
+    from the metadata of messages moved to failed/.
+
+    Only one process may use a spool directory at a time. Messages found in the
+    adopt directories (spools of worker processes that no longer exist) are
+    moved into this spool when it is opened.
+    """
+
+    def __init__(self, directory: str, adopt: list[str] | None = None):
+        self.directory = directory
+        self.adopt = adopt or []
+        self.failed_directory = os.path.join(directory, 'failed')
+        self._ready: asyncio.Queue[str] = asyncio.Queue()
+        self._scheduled: set[str] = set()
+        self._closing = False
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # session tokens of pending messages with the number of messages using each
+        self._tokens: dict[tuple[str, str, str], tuple[oauth.SessionToken, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def _path(self, message_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{message_id}{suffix}")
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        # write under a temporary name so a crash never leaves a partial file behind
+        tmp_path = f"{path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write_message(self, message_id: str, body: bytes, metadata: dict):
+        self._write_file(self._path(message_id, '.eml'), body)
+        self._write_file(self._path(message_id, '.json'), json.dumps(metadata).encode('utf-8'))
+        self._fsync_directory()
+
+    def _write_metadata(self, message_id: str, metadata: dict):
+        self._write_file(self._path(message_id, '.json'), json.dumps(metadata).encode('utf-8'))
+
+    def _read_message(self, message_id: str) -> tuple[bytes, dict]:
+        with open(self._path(message_id, '.json'), 'rb') as f:
+            metadata = json.load(f)
+        with open(self._path(message_id, '.eml'), 'rb') as f:
+            body = f.read()
+        return body, metadata
+
+    def _remove(self, message_id: str):
+        for suffix in ('.json', '.eml'):
+            try:
+                os.remove(self._path(message_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _move_to_failed(self, message_id: str):
+        try:
+            os.replace(self._path(message_id, '.eml'), os.path.join(self.failed_directory, f"{message_id}.eml"))
+        except FileNotFoundError:
+            pass
+
+        # failed messages are kept for inspection indefinitely; never keep their access token
+        path = self._path(message_id, '.json')
+        try:
+            with open(path, 'rb') as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.error(f"Removing unreadable metadata of spooled message '{message_id}': {str(e)}")
+            os.remove(path)
+            return
+        metadata.pop("access_token", None)
+        self._write_file(os.path.join(self.failed_directory, f"{message_id}.json"), json.dumps(metadata).encode('utf-8'))
+        os.remove(path)
+
+    def _adopt(self, directory: str):
+        for name in os.listdir(directory):
+            if not name.endswith('.json'):
+                continue
+            message_id = name[:-5]
+            # move the body first; the metadata file is what marks a message as complete
+            for suffix in ('.eml', '.json'):
+                try:
+                    os.replace(os.path.join(directory, f"{message_id}{suffix}"), self._path(message_id, suffix))
+                except FileNotFoundError:
+                    pass
+            logging.info(f"Adopted spooled message {message_id} from '{directory}'")
+
+    def _recover(self) -> list[tuple[str, float]]:
+        """
+        Scan the spool directory after a restart. Returns (message_id, next_attempt)
+        of every acknowledged message and removes leftovers of interrupted writes.
+        """
+        os.makedirs(self.failed_directory, mode=0o700, exist_ok=True)
+        for directory in self.adopt:
+            if os.path.isdir(directory):
+                self._adopt(directory)
+
+        names = os.listdir(self.directory)
+        committed = {name[:-5] for name in names if name.endswith('.json')}
+        pending = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp') or (name.endswith('.eml') and name[:-4] not in committed):
+                logging.warning(f"Removing incomplete spool file '{name}'")
+                os.remove(path)
+
+        for message_id in committed:
+            try:
+                with open(self._path(message_id, '.json'), 'rb') as f:
+                    pending.append((message_id, json.load(f).get('next_attempt', 0)))
+            except Exception as e:
+                logging.error(f"Failed to read spooled message '{message_id}', moving it to failed: {str(e)}")
+                self._move_to_failed(message_id)
+        return pending
+
+    async def open(self):
+        """
+        Create the spool directories if needed and schedule delivery of every
+        message left over from a previous run.
+        """
+        pending = await asyncio.to_thread(self._recover)
+        now = time.time()
+        for message_id, next_attempt in pending:
+            self._schedule(message_id, max(0.0, next_attempt - now))
+        logging.info(f"Spool opened at '{self.directory}' with {len(pending)} pending message(s)")
+
+    def _schedule(self, message_id: str, delay: float = 0.0):
+        if self._closing:
+            # still on disk; picked up again after the restart
+            return
+        self._scheduled.add(message_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, message_id)
+        else:
+            self._ready.put_nowait(message_id)
+
+    def _hold_token(self, token: oauth.SessionToken):
+        held, count = self._tokens.get(token.key, (token, 0))
+        self._tokens[token.key] = (held, count + 1)
+
+    def _release_token(self, token_key: tuple[str, str, str] | None):
+        held = self._tokens.get(token_key) if token_key else None
+        if held is None:
+            return
+        if held[1] > 1:
+            self._tokens[token_key] = (held[0], held[1] - 1)
+        else:
+            del self._tokens[token_key]
+
+    async def enqueue(self, body: bytes, from_email: str, tenant_id: str, token: oauth.SessionToken) -> str:
+        """
+        Durably store a prepared message for delivery and return its spool id.
+        token is the session's token; it is kept in memory until the message is
+        delivered or given up. Raises OSError if it cannot be written.
+        """
+        message_id = uuid.uuid4().hex
+        now = time.time()
+        metadata = {
+            "from_email": from_email,
+            "tenant_id": tenant_id,
+            "token_key": list(token.key),
+            "created": now,
+            "attempts": 0,
+            "next_attempt": now,
+        }
+        if SPOOL_STORE_TOKEN:
+            metadata["access_token"] = token.access_token
+            metadata["token_expires"] = now + token.lifetime()
+        await asyncio.to_thread(self._write_message, message_id, body, metadata)
+        self._hold_token(token)
+        self._schedule(message_id)
+        logging.debug(f"Spooled message {message_id} ({len(body)} bytes) from {from_email}")
+        return message_id
+
+    def _retry_delay(self, attempts: int, retry_after: float | None) -> float:
+        # exponential backoff with jitter, but never sooner than Graph asked for
+        delay = min(SPOOL_RETRY_MAX, SPOOL_RETRY_BASE * 2 ** (attempts - 1))
+        delay *= random.uniform(0.8, 1.2)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def _access_token(self, token_key: tuple[str, str, str] | None, metadata: dict) -> str | None:
+        """
+        Return a token to deliver a message with, or None if there is none until
+        the credentials log in again. Raises if the held token cannot be renewed.
+        """
+        held = self._tokens.get(token_key) if token_key else None
+        if held is not None:
+            return await held[0].get()
+        cached = oauth.token_cache.get(token_key) if token_key else None
+        if cached is not None:
+            return cached
+        if time.time() < metadata.get("token_expires", 0):
+            return metadata.get("access_token")
+        return None
+
+    async def _give_up(self, message_id: str, token_key: tuple[str, str, str] | None):
+        await asyncio.to_thread(self._move_to_failed, message_id)
+        self._release_token(token_key)
+
+    async def _deliver(self, message_id: str):
+        try:
+            body, metadata = await asyncio.to_thread(self._read_message, message_id)
+        except Exception as e:
+            logging.error(f"Failed to read spooled message {message_id}, moving it to failed: {str(e)}")
+            await asyncio.to_thread(self._move_to_failed, message_id)
+            return
+
+        token_key = tuple(metadata["token_key"]) if metadata.get("token_key") else None
+        age = time.time() - metadata["created"]
+        try:
+            access_token = await self._access_token(token_key, metadata)
+        except Exception as e:
+            logging.warning(f"Could not renew the access token of spooled message {message_id}: {str(e)}")
+            access_token = None
+
+        if access_token is None:
+            # without a usable token, wait for the credentials to log in again
+            if age >= SPOOL_MAX_AGE:
+                logging.error(f"Giving up on spooled message {message_id}: no access token available; moved to failed")
+                await self._give_up(message_id, token_key)
+                return
+            logging.debug(f"Spooled message {message_id} is waiting for a new access token")
+            self._schedule(message_id, SPOOL_RETRY_BASE)
+            return
+
+        result = await scheduler.send(metadata["tenant_id"], access_token, body, metadata["from_email"])
+        if result:
+            await asyncio.to_thread(self._remove, message_id)
+            self._release_token(token_key)
+            logging.info(f"Delivered spooled message {message_id}")
+            return
+
+        metadata["attempts"] += 1
+        if result.status_code == 401 and token_key and age < SPOOL_MAX_AGE:
+            # the token expired or was revoked; forget it everywhere and wait for a new one
+            metadata.pop("access_token", None)
+            metadata.pop("token_expires", None)
+            if oauth.token_cache.get(token_key) == access_token:
+                oauth.token_cache.pop(token_key)
+            held = self._tokens.get(token_key)
+            if held is not None:
+                held[0].expire()
+            await asyncio.to_thread(self._write_metadata, message_id, metadata)
+            logging.warning(f"Graph rejected the access token of spooled message {message_id}; waiting for a new one")
+            self._schedule(message_id, SPOOL_RETRY_BASE)
+            return
+
+        if not result.retryable or age >= SPOOL_MAX_AGE:
+            logging.error(
+                f"Giving up on spooled message {message_id} after {metadata['attempts']} attempt(s) "
+                f"(status={result.status_code}); moved to failed"
+            )
+            await self._give_up(message_id, token_key)
+            return
+
+        delay = self._retry_delay(metadata["attempts"], result.retry_after)
+        metadata["next_attempt"] = time.time() + delay
+        await asyncio.to_thread(self._write_metadata, message_id, metadata)
+        logging.warning(f"Delivery of spooled message {message_id} failed (status={result.status_code}); retrying in {delay:.0f}s")
+        self._schedule(message_id, delay)
+
+    async def _worker(self):
+        while not self._closing:
+            message_id = await self._ready.get()
+            if self._closing:
+                return
+            self._scheduled.discard(message_id)
+            self._active += 1
+            self._idle.clear()
+            try:
+                await self._deliver(message_id)
+            except Exception as e:
+                logging.exception(f"Unexpected error delivering spooled message {message_id}: {str(e)}")
+                self._schedule(message_id, SPOOL_RETRY_MAX)
+            finally:
+                self._active -= 1
+                if not self._active:
+                    self._idle.set()
+
+    async def close(self, timeout: float) -> bool:
+        """
+        Stop starting new deliveries and wait up to timeout seconds for the ones
+        in progress. Returns False if some are still running. Undelivered
+        messages stay in the spool directory.
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self):
+        """
+        Deliver spooled messages with SPOOL_WORKERS concurrent workers. Runs until cancelled.
+        """
+        await asyncio.gather(*(self._worker() for _ in range(SPOOL_WORKERS)))
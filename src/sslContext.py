@@ -1,84 +1,206 @@
+import asyncio
+import os
 import ssl
 import logging
+import tempfile
 
+from env import TLS_CIPHER_SUITE, TLS_SESSION_TICKETS
 
-def from_keyvault(azure_key_vault_url, azure_key_vault_cert_name):
+
+def _configure(context: ssl.SSLContext):
     """
-    Load certificate from Azure Key Vault.
-    Returns ssl.SSLContext object.
+    Apply the TLS settings shared by every context the server uses.
+    """
+    if TLS_CIPHER_SUITE:
+        context.set_ciphers(TLS_CIPHER_SUITE)
+
+    # Session tickets let reconnecting clients resume without a full handshake
+    context.num_tickets = TLS_SESSION_TICKETS
+    if TLS_SESSION_TICKETS == 0:
+        context.options |= ssl.OP_NO_TICKET
+
+
+def _context_from_pem(pem: bytes) -> ssl.SSLContext:
+    """
+    Create a server context from PEM data holding the private key and certificate chain.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+
+    # load_cert_chain only reads from a path; on Linux the key is put in an
+    # anonymous in-memory file, elsewhere in a private directory removed right away
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('tls-cert', os.MFD_CLOEXEC)
+        try:
+            os.write(fd, pem)
+            context.load_cert_chain(certfile=f"/proc/self/fd/{fd}")
+        finally:
+            os.close(fd)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cert.pem')
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                f.write(pem)
+            context.load_cert_chain(certfile=path)
+    return context
+
+
+class FileSource:
     """
-    from azure.identity import DefaultAzureCredential
-    from azure.keyvault.secrets import SecretClient
-    from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat
-    from cryptography.hazmat.primitives.serialization import pkcs12
-    import base64
-    from tempfile import NamedTemporaryFile
-
-    # Create a secret client
-    credential = DefaultAzureCredential()
-    client = SecretClient(vault_url=azure_key_vault_url, credential=credential)
-        
-    cert_secret = client.get_secret(azure_key_vault_cert_name)
-    if not cert_secret or not cert_secret.value:
-        logging.error("Certificate not found in Key Vault")
-        raise ValueError("Certificate not found in Key Vault")
-
-    cert_data = base64.b64decode(cert_secret.value)
-    # Load the certificate and key from the PKCS#12 data
-    try:
-        private_key, certificate, _ = pkcs12.load_key_and_certificates(cert_data, None)
-    except Exception as e:
-        logging.error(f"Failed to load PKCS#12 data: {str(e)}")
-        raise
-
-    # Create a temporary file to store the certificate and key
-    with NamedTemporaryFile(delete=False) as cert_file, NamedTemporaryFile(delete=False) as key_file:
-        # write certificate
+    Certificate and key from PEM files; reloaded when either file changes.
+    """
+
+    def __init__(self, cert_filepath: str, key_filepath: str):
+        self.cert_filepath = cert_filepath
+        self.key_filepath = key_filepath
+
+    def __str__(self) -> str:
+        return f"file {self.cert_filepath}"
+
+    def load(self, version) -> tuple[object, ssl.SSLContext] | None:
+        # check if cert and key files exist
+        if not os.path.exists(path=self.cert_filepath) or not os.path.exists(path=self.key_filepath):
+            logging.error("Certificate or key not found")
+            raise FileNotFoundError("Certificate or key not found")
+
+        # the modification time and size of both files identify the version
+        new_version = tuple(
+            (stat.st_mtime_ns, stat.st_size)
+            for stat in (os.stat(self.cert_filepath), os.stat(self.key_filepath))
+        )
+        if new_version == version:
+            return None
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        try:
+            context.load_cert_chain(certfile=self.cert_filepath, keyfile=self.key_filepath)
+        except ssl.SSLError as e:
+            logging.error(f"Failed to load Certificate or key: {str(e)}")
+            raise
+        except FileNotFoundError as e:
+            logging.error(f"Certificate or key not found: {str(e)}")
+            raise
+        return new_version, context
+
+
+class KeyVaultSource:
+    """
+    Certificate from Azure Key Vault (PKCS#12, read through its secret); reloaded
+    when a new version of the certificate is published.
+    """
+
+    def __init__(self, azure_key_vault_url: str, azure_key_vault_cert_name: str):
+        from azure.identity import DefaultAzureCredential
+        from azure.keyvault.secrets import SecretClient
+
+        self.cert_name = azure_key_vault_cert_name
+        # reused for every check, so polling does not fetch a new managed identity token each time
+        self.client = SecretClient(vault_url=azure_key_vault_url, credential=DefaultAzureCredential())
+
+    def __str__(self) -> str:
+        return f"Azure Key Vault certificate {self.cert_name}"
+
+    def load(self, version) -> tuple[object, ssl.SSLContext] | None:
+        from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        import base64
+
+        cert_secret = self.client.get_secret(self.cert_name)
+        if not cert_secret or not cert_secret.value:
+            logging.error("Certificate not found in Key Vault")
+            raise ValueError("Certificate not found in Key Vault")
+        if cert_secret.properties.version is not None and cert_secret.properties.version == version:
+            return None
+
+        cert_data = base64.b64decode(cert_secret.value)
+        # Load the certificate and key from the PKCS#12 data
+        try:
+            private_key, certificate, chain = pkcs12.load_key_and_certificates(cert_data, None)
+        except Exception as e:
+            logging.error(f"Failed to load PKCS#12 data: {str(e)}")
+            raise
+
         if certificate is None:
             logging.error("No certificate found in PKCS#12 data")
             raise ValueError("No certificate found in PKCS#12 data")
-        cert_file.write(certificate.public_bytes(Encoding.PEM))
-        cert_file.flush()
-
-        # write private key
         if private_key is None:
             logging.error("No private key found in PKCS#12 data")
             raise ValueError("No private key found in PKCS#12 data")
-        key_file.write(private_key.private_bytes(
+
+        pem = private_key.private_bytes(
             encoding=Encoding.PEM,
             format=PrivateFormat.TraditionalOpenSSL,
             encryption_algorithm=NoEncryption()
-        ))
-        key_file.flush()
-    
+        ) + b''.join(cert.public_bytes(Encoding.PEM) for cert in [certificate, *chain])
+        return cert_secret.properties.version, _context_from_pem(pem)
 
-        # Create SSL context
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(certfile=cert_file.name, keyfile=key_file.name)
 
-    return context
+class ReloadableContext:
+    """
+    Server TLS context whose certificate can be replaced while the server runs.
+
+    The context handed to the SMTP server stays the same; its SNI callback, which
+    runs early in every handshake, switches the connection to the most recently
+    loaded context. Connections already established are not affected. TLS
+    session tickets stay valid across reloads, since their keys belong to the
+    original context.
+    """
+
+    def __init__(self, source: FileSource | KeyVaultSource):
+        self.source = source
+        self.version = None
+        self.context: ssl.SSLContext | None = None
+        self._current: ssl.SSLContext | None = None
 
+    def load(self) -> bool:
+        """
+        Load the certificate if it changed since the last load. Returns True if a
+        new certificate is in use. Blocking; call it from a thread once the server runs.
+        """
+        result = self.source.load(self.version)
+        if result is None:
+            return False
 
-def from_file(cert_filepath, key_filepath):
+        version, context = result
+        _configure(context)
+        if self.context is None:
+            context.sni_callback = self._select
+            self.context = context
+        self.version = version
+        self._current = context
+        return True
+
+    def _select(self, ssl_object, server_name, context):
+        if ssl_object.context is not self._current:
+            ssl_object.context = self._current
+        return None
+
+    async def watch(self, interval: float):
+        """
+        Check for a new certificate every interval seconds. If loading fails, the
+        current certificate stays in use. Runs until cancelled.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await asyncio.to_thread(self.load):
+                    logging.info(f"Loaded new certificate from {self.source}")
+            except Exception as e:
+                logging.error(f"Failed to reload the certificate from {self.source}; keeping the current one: {str(e)}")
+
+
+def from_keyvault(azure_key_vault_url, azure_key_vault_cert_name) -> ReloadableContext:
     """
-    Load certificate and key from file paths.
-    Returns ssl.SSLContext object.
+    Load certificate from Azure Key Vault.
     """
-    import os
-
-    # check if cert and key files exist
-    if not os.path.exists(path=cert_filepath) or not os.path.exists(path=key_filepath):
-        logging.error("Certificate or key not found")
-        raise FileNotFoundError("Certificate or key not found")
+    context = ReloadableContext(KeyVaultSource(azure_key_vault_url, azure_key_vault_cert_name))
+    context.load()
+    return context
 
 
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    try:
-        context.load_cert_chain(certfile=cert_filepath, keyfile=key_filepath)
-    except ssl.SSLError as e:
-        logging.error(f"Failed to load Certificate or key: {str(e)}")
-        raise
-    except FileNotFoundError as e:
-        logging.error(f"Certificate or key not found: {str(e)}")
-        raise
+def from_file(cert_filepath, key_filepath) -> ReloadableContext:
+    """
+    Load certificate and key from file paths.
+    """
+    context = ReloadableContext(FileSource(cert_filepath, key_filepath))
+    context.load()
     return context
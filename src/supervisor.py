@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from typing import Callable
+
+from prometheus_client import CollectorRegistry, multiprocess
+
+import monitoring
+from env import MONITORING_PORT, SHUTDOWN_TIMEOUT
+
+
+# Seconds a new worker may take to start listening before it is considered failed
+_READY_TIMEOUT = 60
+
+# Seconds a worker gets to exit after SIGTERM before it is killed; on top of
+# SHUTDOWN_TIMEOUT for draining, leaves time to close clients and pools
+_STOP_TIMEOUT = SHUTDOWN_TIMEOUT + 10
+
+# Upper bound for the delay before restarting a worker that keeps crashing
+_RESTART_DELAY_MAX = 30
+
+# A worker that ran at least this long is not considered crash-looping
+_STABLE_AFTER = 60
+
+
+class _Worker:
+    __slots__ = ('process', 'ready', 'started', 'failures')
+
+    def __init__(self, process: multiprocessing.Process, ready, failures: int = 0):
+        self.process = process
+        self.ready = ready
+        self.started = time.monotonic()
+        self.failures = failures
+
+
+class Supervisor:
+    """
+    Runs the relay in several worker processes so it can use more than one CPU core.
+
+    Every worker runs its own event loop and binds the SMTP port with SO_REUSEPORT,
+    so the kernel spreads incoming connections across them. Workers that exit
+    unexpectedly are restarted, with a growing delay if they keep crashing.
+    SIGHUP replaces the workers one at a time, so the others keep accepting
+    connections meanwhile. A worker slot never has two processes at once, which
+    lets each slot own its spool directory.
+
+    Workers write their Prometheus metrics to a shared directory; the supervisor
+    aggregates them and serves /metrics on MONITORING_PORT.
+    """
+
+    def __init__(self, target: Callable, count: int):
+        self.target = target
+        self.count = count
+        self.context = multiprocessing.get_context('spawn')
+        self.workers: list[_Worker | None] = [None] * count
+        self.metrics_dir = tempfile.mkdtemp(prefix='smtp-relay-metrics-')
+        self._stopping = asyncio.Event()
+        self._restarting = False
+
+    def status(self) -> dict:
+        """
+        Return the readiness report served on /readyz: ready while at least one
+        worker is running and listening. Load details are in the aggregated metrics.
+        """
+        workers = []
+        for worker in self.workers:
+            if worker is None or not worker.process.is_alive():
+                workers.append("restarting")
+            elif worker.ready.is_set():
+                workers.append("ready")
+            else:
+                workers.append("starting")
+        return {
+            "ready": not self._stopping.is_set() and "ready" in workers,
+            "draining": self._stopping.is_set(),
+            "workers": workers
+        }
+
+    def _spawn(self, slot: int, failures: int = 0) -> _Worker:
+        ready = self.context.Event()
+        process = self.context.Process(target=self.target, args=(slot, ready), name=f"worker-{slot}")
+        process.start()
+        logging.info(f"Started worker {slot} (pid {process.pid})")
+        return _Worker(process, ready, failures)
+
+    async def _stop_worker(self, worker: _Worker):
+        worker.process.terminate()
+        await asyncio.to_thread(worker.process.join, _STOP_TIMEOUT)
+        if worker.process.is_alive():
+            logging.warning(f"Worker pid {worker.process.pid} did not stop in time, killing it")
+            worker.process.kill()
+            await asyncio.to_thread(worker.process.join)
+        multiprocess.mark_process_dead(worker.process.pid, self.metrics_dir)
+
+    async def _rolling_restart(self):
+        if self._restarting:
+            return
+        self._restarting = True
+        logging.info("Restarting workers")
+        try:
+            for slot, old in enumerate(self.workers):
+                if self._stopping.is_set():
+                    return
+                if old is None:
+                    # already waiting to be restarted after a crash
+                    continue
+                self.workers[slot] = None
+                await self._stop_worker(old)
+                new = self.workers[slot] = self._spawn(slot)
+                if not await asyncio.to_thread(new.ready.wait, _READY_TIMEOUT):
+                    logging.error(f"Worker {slot} did not become ready after restart; aborting the restart")
+                    return
+        finally:
+            self._restarting = False
+
+    def _check_workers(self):
+        for slot, worker in enumerate(self.workers):
+            if worker is None or worker.process.is_alive():
+                continue
+
+            multiprocess.mark_process_dead(worker.process.pid, self.metrics_dir)
+            failures = 0 if time.monotonic() - worker.started >= _STABLE_AFTER else worker.failures + 1
+            delay = min(_RESTART_DELAY_MAX, 2 ** failures - 1)
+            logging.error(f"Worker {slot} (pid {worker.process.pid}) exited with code {worker.process.exitcode}; restarting in {delay}s")
+
+            self.workers[slot] = None
+            asyncio.get_running_loop().call_later(delay, self._restart_slot, slot, failures)
+
+    def _restart_slot(self, slot: int, failures: int):
+        if not self._stopping.is_set() and self.workers[slot] is None:
+            self.workers[slot] = self._spawn(slot, failures)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self._stopping.set)
+        loop.add_signal_handler(signal.SIGINT, self._stopping.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(self._rolling_restart()))
+
+        if MONITORING_PORT:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=self.metrics_dir)
+            await monitoring.start(MONITORING_PORT, registry, self.status)
+
+        for slot in range(self.count):
+            self.workers[slot] = self._spawn(slot)
+        logging.info(f"Supervisor started {self.count} workers")
+
+        while not self._stopping.is_set():
+            self._check_workers()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        logging.info("Stopping workers...")
+        await asyncio.gather(*(self._stop_worker(worker) for worker in self.workers if worker is not None))
+        await monitoring.close()
+
+
+def supervise(target: Callable, count: int):
+    """
+    Run target(slot, ready_event) in count worker processes until SIGTERM or SIGINT.
+    target must set ready_event once its SMTP server is listening.
+    """
+    supervisor = Supervisor(target, count)
+
+    # must be set before the workers import prometheus_client
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = supervisor.metrics_dir
+    try:
+        asyncio.run(supervisor.run())
+    finally:
+        shutil.rmtree(supervisor.metrics_dir, ignore_errors=True)
@@ -0,0 +1,336 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+
+import metrics
+from batch import batcher
+from graph import SendResult, send_email
+from env import (
+    GRAPH_MAX_CONCURRENCY,
+    GRAPH_MAILBOX_CONCURRENCY,
+    GRAPH_TENANT_RATE,
+    GRAPH_TENANT_BURST,
+    GRAPH_MAILBOX_RATE,
+    GRAPH_MAILBOX_BURST,
+    GRAPH_THROTTLE_TIMEOUT
+)
+
+
+# Upper bound on tracked tenants and mailboxes; idle ones are forgotten first
+_MAX_TENANTS = 10000
+_MAX_MAILBOXES = 10000
+
+# Backoff applied to a mailbox when Graph answers 429 without a Retry-After header
+_DEFAULT_BACKOFF = 10.0
+
+
+class TokenBucket:
+    """
+    Token bucket allowing rate requests per second with bursts of up to capacity.
+    A rate of 0 or less means unlimited. block() stops all requests until the
+    given time, which is how Retry-After from Graph is honoured.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        Return how many seconds to wait until a token is available, 0 if one is available now.
+        """
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+
+
+class _Mailbox:
+    __slots__ = ('bucket', 'active')
+
+    def __init__(self):
+        self.bucket = TokenBucket(GRAPH_MAILBOX_RATE, GRAPH_MAILBOX_BURST)
+        self.active = 0
+
+
+class _Waiter:
+    __slots__ = ('mailbox_key', 'future', 'tokens', 'slots', 'global_slot')
+
+    def __init__(self, mailbox_key: tuple[str, str], future: asyncio.Future, tokens: bool, slots: int, global_slot: bool):
+        self.mailbox_key = mailbox_key
+        self.future = future
+        # whether the waiter needs rate-limit tokens, how many mailbox slots and whether a global slot
+        self.tokens = tokens
+        self.slots = slots
+        self.global_slot = global_slot
+
+
+class GraphScheduler:
+    """
+    Admission control for Graph send requests.
+
+    Every request needs a token from its tenant's bucket, a token from its
+    mailbox's bucket, one of GRAPH_MAILBOX_CONCURRENCY slots of the mailbox and
+    one of GRAPH_MAX_CONCURRENCY global slots. Waiting requests are queued per
+    tenant and admitted round-robin across tenants, so a tenant with a deep
+    backlog cannot starve the others. Within a tenant, requests are admitted in
+    order, except that a request for a blocked mailbox does not hold up the
+    tenant's other mailboxes.
+
+    With batching, every message still takes its rate tokens, but only the
+    batch request takes concurrency slots: one global slot, and one mailbox
+    slot per message, since Graph runs the requests in a batch concurrently.
+    The batcher puts at most GRAPH_MAILBOX_CONCURRENCY messages of one mailbox
+    into a batch, so its slots can always be granted.
+
+    A 429 pauses the mailbox until Retry-After has passed, or the whole tenant
+    if Graph reports a tenant-wide limit in x-ms-throttle-scope.
+    """
+
+    def __init__(self):
+        self._queues: OrderedDict[str, deque[_Waiter]] = OrderedDict()
+        self._tenants: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._mailboxes: OrderedDict[tuple[str, str], _Mailbox] = OrderedDict()
+        self._active = 0
+        self._timer: asyncio.TimerHandle | None = None
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _tenant(self, tenant_id: str) -> TokenBucket:
+        bucket = self._tenants.get(tenant_id)
+        if bucket is None:
+            bucket = self._tenants[tenant_id] = TokenBucket(GRAPH_TENANT_RATE, GRAPH_TENANT_BURST)
+            if len(self._tenants) > _MAX_TENANTS:
+                self._evict_idle_tenant()
+        self._tenants.move_to_end(tenant_id)
+        return bucket
+
+    def _evict_idle_tenant(self):
+        now = time.monotonic()
+        for tenant_id, bucket in self._tenants.items():
+            if tenant_id not in self._queues and bucket.blocked_until <= now:
+                del self._tenants[tenant_id]
+                return
+
+    def _mailbox(self, key: tuple[str, str]) -> _Mailbox:
+        mailbox = self._mailboxes.get(key)
+        if mailbox is None:
+            mailbox = self._mailboxes[key] = _Mailbox()
+            if len(self._mailboxes) > _MAX_MAILBOXES:
+                self._evict_idle_mailbox()
+        self._mailboxes.move_to_end(key)
+        return mailbox
+
+    def _evict_idle_mailbox(self):
+        now = time.monotonic()
+        for key, mailbox in self._mailboxes.items():
+            if mailbox.active == 0 and mailbox.bucket.blocked_until <= now:
+                del self._mailboxes[key]
+                return
+
+    def _admit(self, tenant_id: str, queue: deque[_Waiter], now: float) -> float | None:
+        """
+        Admit the first eligible waiter of a tenant. Returns None if one was
+        admitted, otherwise the seconds until one might be (inf if unknown).
+        """
+        tenant = self._tenant(tenant_id)
+        tenant_wait = tenant.wait_time(now)
+
+        wait = float('inf')
+        for waiter in queue:
+            if waiter.future.done():
+                continue
+            mailbox = self._mailbox(waiter.mailbox_key)
+            if waiter.slots and mailbox.active + waiter.slots > max(GRAPH_MAILBOX_CONCURRENCY, waiter.slots):
+                continue
+            if waiter.slots and waiter.global_slot and self._active >= GRAPH_MAX_CONCURRENCY:
+                continue
+            if waiter.tokens:
+                if tenant_wait > 0:
+                    wait = min(wait, tenant_wait)
+                    continue
+                mailbox_wait = mailbox.bucket.wait_time(now)
+                if mailbox_wait > 0:
+                    wait = min(wait, mailbox_wait)
+                    continue
+                tenant.take(now)
+                mailbox.bucket.take(now)
+
+            if waiter.slots:
+                mailbox.active += waiter.slots
+                if waiter.global_slot:
+                    self._active += 1
+            queue.remove(waiter)
+            waiter.future.set_result(None)
+            return None
+        return wait
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        now = time.monotonic()
+        next_wake = float('inf')
+        while True:
+            admitted = False
+            for tenant_id, queue in list(self._queues.items()):
+                # drop waiters that gave up (timed out or cancelled)
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if not queue:
+                    del self._queues[tenant_id]
+                    continue
+
+                wait = self._admit(tenant_id, queue, now)
+                if wait is None:
+                    # served this round; go to the back of the line
+                    if queue:
+                        self._queues.move_to_end(tenant_id)
+                    else:
+                        del self._queues[tenant_id]
+                    admitted = True
+                    break
+                next_wake = min(next_wake, wait)
+            if not admitted:
+                break
+
+        # requests blocked only by concurrency limits are woken by release()
+        if self._queues and next_wake != float('inf'):
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
+
+    async def acquire(self, tenant_id: str, from_email: str, tokens: bool = True, slots: int = 1, global_slot: bool = True) -> tuple[str, str]:
+        """
+        Wait until a request for this tenant and mailbox may be sent. Returns the
+        mailbox key, which must be passed to release() once the request is done
+        if slots were acquired. slots mailbox slots are granted at once; with
+        global_slot=False no global slot is taken along with them.
+        """
+        key = (tenant_id, from_email.lower())
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(tenant_id, deque()).append(_Waiter(key, future, tokens, slots, global_slot))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # the slots may have been granted just before the cancellation
+            if slots and future.done() and not future.cancelled():
+                self.release(key, slots, global_slot)
+            raise
+        return key
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tenant_id: str, from_emails: list[str], timeout: float = GRAPH_THROTTLE_TIMEOUT):
+        """
+        Hold concurrency slots, but no rate tokens, for one batch request: one
+        global slot and a mailbox slot for every message, given by the sender
+        addresses in from_emails. Mailboxes are taken in sorted order, so batches
+        waiting for each other's mailboxes cannot deadlock. Raises
+        asyncio.TimeoutError if the slots are not all free within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        counts = Counter(email.lower() for email in from_emails)
+        held: list[tuple[tuple[str, str], int, bool]] = []
+        try:
+            for index, from_email in enumerate(sorted(counts)):
+                key = await asyncio.wait_for(
+                    self.acquire(tenant_id, from_email, tokens=False, slots=counts[from_email], global_slot=index == 0),
+                    max(0.0, deadline - time.monotonic())
+                )
+                held.append((key, counts[from_email], index == 0))
+            yield
+        finally:
+            for key, slots, global_slot in held:
+                self.release(key, slots, global_slot)
+
+    def release(self, key: tuple[str, str], slots: int = 1, global_slot: bool = True):
+        if global_slot:
+            self._active -= 1
+        mailbox = self._mailboxes.get(key)
+        if mailbox:
+            mailbox.active -= slots
+        self._dispatch()
+
+    def backoff(self, key: tuple[str, str], retry_after: float | None, scope: str | None = None):
+        """
+        Stop sending for a throttled mailbox, or its whole tenant if the limit
+        Graph reported is tenant-wide, until Graph's Retry-After has passed.
+        """
+        delay = retry_after if retry_after is not None else _DEFAULT_BACKOFF
+        if scope and scope.lower().startswith('tenant'):
+            self._tenant(key[0]).block(time.monotonic() + delay)
+            logging.warning(f"Graph throttled tenant '{key[0]}' ({scope}); pausing it for {delay:.0f}s")
+            return
+        self._mailbox(key).bucket.block(time.monotonic() + delay)
+        logging.warning(f"Graph throttled mailbox '{key[1]}' of tenant '{key[0]}'; pausing it for {delay:.0f}s")
+
+    async def send(self, tenant_id: str, access_token: str, body: bytes, from_email: str, timeout: float = GRAPH_THROTTLE_TIMEOUT) -> SendResult:
+        """
+        Send a message through the batcher once the rate limits allow it. Throttled
+        requests are retried after Retry-After as long as that fits in timeout
+        seconds; otherwise a retryable failure is returned.
+        """
+        deadline = time.monotonic() + timeout
+        batched = batcher.accepts(body)
+        while True:
+            try:
+                with metrics.GRAPH_QUEUE_DURATION.time():
+                    key = await asyncio.wait_for(
+                        self.acquire(tenant_id, from_email, slots=0 if batched else 1),
+                        max(0.0, deadline - time.monotonic())
+                    )
+            except asyncio.TimeoutError:
+                logging.warning(f"Timed out waiting for a Graph send slot for '{from_email}'")
+                return SendResult(success=False, retryable=True)
+
+            if batched:
+                result = await batcher.send(
+                    access_token, body, from_email,
+                    lambda from_emails: self.slot(tenant_id, from_emails, max(0.0, deadline - time.monotonic()))
+                )
+            else:
+                try:
+                    with metrics.round_trip('graph', metrics.GRAPH_REQUEST_DURATION):
+                        result = await send_email(access_token, body, from_email)
+                finally:
+                    self.release(key)
+            metrics.record_graph_response(result.status_code)
+
+            if result.status_code != 429:
+                return result
+            self.backoff(key, result.retry_after, result.throttle_scope)
+            if time.monotonic() + (result.retry_after or _DEFAULT_BACKOFF) >= deadline:
+                return result
+
+
+scheduler = GraphScheduler()